@@ -1,7 +1,8 @@
 from flask_api import FlaskAPI, status
-from flask import request
+from flask import Response, request
 
-from .nlsql.handler import parsing_text
+from .nlsql import metrics
+from .nlsql.handler import invalidate_translation_cache, parsing_text
 from .nlsql.nlsql_typing import NLSQLAnswer
 
 import asyncio
@@ -20,8 +21,23 @@ def post_nlsql():
         if os.getenv('DEBUG', '') == '1':
             logging.info('This is json request')
         nlsql_answer: NLSQLAnswer = loop.run_until_complete(parsing_text(request.json.get('channel_id', ''),
-                                                                         request.json.get('text', '')))
+                                                                         request.json.get('text', ''),
+                                                                         request.json.get('conversation_id', ''),
+                                                                         request.json.get('report_format', '')))
 
         return nlsql_answer, status.HTTP_200_OK
 
     return '', status.HTTP_400_BAD_REQUEST
+
+
+@app.route("/nlsql-analyzer/cache", methods=['DELETE'])
+def delete_nlsql_cache():
+    # Call after the data-source schema changes so questions are translated again
+    invalidate_translation_cache()
+    return '', status.HTTP_204_NO_CONTENT
+
+
+@app.route("/metrics", methods=['GET'])
+def get_metrics():
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
@@ -0,0 +1,118 @@
+"""ASGI entry point for the NLSQL analyzer.
+
+Serves the same ``/nlsql-analyzer`` contract as the Flask app in ``api/__init__.py`` but awaits
+``parsing_text`` on the worker's long-lived event loop, so a single worker multiplexes many
+in-flight conversations while they wait on the NLSQL API, the database or the chart renderer.
+
+Run with::
+
+    gunicorn -k uvicorn.workers.UvicornWorker -b 0.0.0.0:8000 api.asgi:app
+"""
+import datetime
+import decimal
+import json
+import logging
+import os
+import uuid
+
+from werkzeug.http import http_date
+
+from .nlsql import artifacts, http_client, metrics, render
+from .nlsql.connectors import connectors
+from .nlsql.handler import invalidate_translation_cache, parsing_text
+
+JSON_MIMETYPES = ('application/json',)
+
+
+def _json_default(o):
+    # Mirrors the Flask JSON encoder so both serving modes return identical payloads
+    if isinstance(o, (datetime.date, datetime.datetime)):
+        return http_date(o)
+    if isinstance(o, (decimal.Decimal, uuid.UUID)):
+        return str(o)
+    raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+
+
+def _is_json(headers) -> bool:
+    content_type = headers.get(b'content-type', b'').decode('latin-1')
+    mimetype = content_type.split(';', 1)[0].strip().lower()
+    return mimetype in JSON_MIMETYPES or (mimetype.startswith('application/') and mimetype.endswith('+json'))
+
+
+async def _read_body(receive) -> bytes:
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def _send_response(send, status: int, body: bytes = b'', content_type: bytes = b'application/json'):
+    await send({'type': 'http.response.start',
+                'status': status,
+                'headers': [(b'content-type', content_type),
+                            (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            render.start()
+            artifacts.start_sweeper()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await artifacts.stop_sweeper()
+            await http_client.close_session()
+            await connectors.close_pools()
+            render.shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def post_nlsql(scope, receive, send):
+    if os.getenv('DEBUG', '') == '1':
+        logging.info('Get request')
+    headers = dict(scope.get('headers', []))
+    body = await _read_body(receive)
+    if not _is_json(headers):
+        return await _send_response(send, 400)
+    try:
+        data = json.loads(body or b'null')
+    except ValueError:
+        return await _send_response(send, 400)
+    if not isinstance(data, dict):
+        return await _send_response(send, 400)
+    if os.getenv('DEBUG', '') == '1':
+        logging.info('This is json request')
+
+    nlsql_answer = await parsing_text(data.get('channel_id', ''), data.get('text', ''),
+                                      data.get('conversation_id', ''), data.get('report_format', ''))
+    await _send_response(send, 200, json.dumps(nlsql_answer, default=_json_default).encode())
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    if scope['path'] == '/nlsql-analyzer':
+        if scope['method'] != 'POST':
+            return await _send_response(send, 405)
+        return await post_nlsql(scope, receive, send)
+    if scope['path'] == '/nlsql-analyzer/cache':
+        if scope['method'] != 'DELETE':
+            return await _send_response(send, 405)
+        invalidate_translation_cache()
+        return await _send_response(send, 204)
+    if scope['path'] == '/metrics':
+        if scope['method'] != 'GET':
+            return await _send_response(send, 405)
+        body, content_type = metrics.render()
+        return await _send_response(send, 200, body, content_type.encode())
+
+    await _send_response(send, 404)
@@ -1,7 +1,7 @@
-import requests
 import os
 import sys
 import asyncio
+import aiohttp
 import pandas as pd
 import numpy as np
 from scipy.interpolate import UnivariateSpline
@@ -24,6 +24,7 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from nlsql.handler import api_post
 from nlsql.connectors import connectors
+from nlsql import artifacts, graph, http_client, images
 
 
 # Email configuration
@@ -43,8 +44,9 @@ mode_mapping = {
 corridors_mode = mode_mapping.get(corridors_mode_input.lower(), 2)  # Default to '2' if input is not recognized
 
 
-def get_table_data():
+async def get_table_data():
     '''Function to retrieve the users data sources and table data.'''
+    session = await http_client.get_session()
     try:
         headers = {
             "Authorization": 'Token ' + os.getenv("ApiToken")
@@ -52,16 +54,16 @@ def get_table_data():
 
         # Request DataSource names
         url = "https://api.nlsql.com/v1/data-source/"
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        data_sources = response.json()
+        async with session.get(url, headers=headers) as response:
+            response.raise_for_status()
+            data_sources = await response.json()
 
         # Append DataSource names to a list
         datasource_names = []
         for data_source in data_sources:
             datasource_names.append(data_source['name'])
 
-    except requests.RequestException as e:
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         logging.error(f"Failed to retrieve datasource names: {e}")
         return []
     
@@ -71,9 +73,9 @@ def get_table_data():
         # Loop DataSource names and request table names, kpi args and filters.
         table_data = {}
         for name in datasource_names:
-            response = requests.get(base_url + name, headers=headers)
-            response.raise_for_status()
-            data = response.json()['tables']
+            async with session.get(base_url + name, headers=headers) as response:
+                response.raise_for_status()
+                data = (await response.json())['tables']
             table_data[name] = []
             for table in data:
                 table_data[name].append({
@@ -83,7 +85,7 @@ def get_table_data():
                 })
         return table_data
     
-    except requests.RequestException as e:
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         logging.error(f"Failed to retrieve table data for {name}: {e}")
         return {}
 
@@ -395,23 +397,21 @@ def generate_graph(trusted_df, comparison_df, anomalies, corridors, kpi, fltr=''
             template="plotly_white"
         )
 
-        img_buf = BytesIO()
-        fig.write_image(img_buf, format='png')
-        img_buf.seek(0)
-
+        # the PNG for the email is exported later together with the other graphs, see render_graphs()
         try:
             # Save the figure as an HTML file
-            app_name = os.getenv('StaticEndPoint')
-            file_name = f"pio_{kpi}_{datetime.now().strftime('%Y%m%d%H%M%S')}.html"
-            file_path = '/var/www/html/bot/static/{}'.format(file_name)
-            fig.write_html(file_path)
-
-            url = '{}/bot/static/{}'.format(app_name, file_name)
-            return img_buf, url
+            file_name = artifacts.relative(f"pio_{kpi}_{datetime.now().strftime('%Y%m%d%H%M%S')}.html")
+            file_path = artifacts.path(file_name)
+            fig.write_html(file_path, include_plotlyjs=graph.plotlyjs())
+            artifacts.record(file_name)
+            artifacts.write_sidecars(file_name)
+
+            url = artifacts.url(file_name)
+            return fig, url
         
         except Exception as e:
             logging.error(f"Failed to generate URL: {e}")
-            return img_buf, None
+            return fig, None
     
     except Exception as e:
         logging.error(f"Error in generate_graph: {e}")
@@ -474,7 +474,7 @@ async def gather_anomaly_data(data_source, table, kpi, fltr, trusted_sql, compar
 
         # Generate graph image and URL
         graph, url = generate_graph(trusted_df, comparison_df, anomalies, corridors, kpi, fltr)
-        if graph:
+        if graph is not None:
             if url:
                 logging.info('Graph and URL successfully generated.')
             else:
@@ -502,14 +502,14 @@ async def perform_anomaly_check():
     '''Function to loop all tables, KPIs and filters and gather anomaly data'''
     try:
         # Get data for checks (datasources, table names, KPI args and filters)
-        table_data = get_table_data()
+        table_data = await get_table_data()
 
         # Create a connection to the user's database
         db = os.getenv('DatabaseType', 'postgresql').lower()
         db_params = await connectors.get_db_param(db)
         conn = None
         try:
-            conn = await connectors.get_connector(db, **db_params)
+            conn = await connectors.acquire_connection(db, **db_params)
             logging.info("Successfully connected to database.")
         except:
             logging.error("Unable to connect to database.")
@@ -544,7 +544,7 @@ async def perform_anomaly_check():
         
         # Send email to user
         if EMAIL_ADDRESS and EMAIL_PASSWORD and RECIPIENT_EMAIL:
-            send_email(anomaly_messages, searched_tables)
+            send_email(render_graphs(anomaly_messages), searched_tables)
         else:
             logging.warning("Email credentials missing")
         return
@@ -555,7 +555,20 @@ async def perform_anomaly_check():
     
     finally:
         if conn:
-            await conn.close() 
+            await connectors.release_connection(db, conn)
+
+
+def render_graphs(anomaly_messages):
+    '''Function to export the PNGs of all anomaly graphs in one batch on the same kaleido renderer'''
+    figures = [message[2] for message in anomaly_messages if message is not None and message[2] is not None]
+    images_png = iter(images.to_images(figures, 'png'))
+    rendered = []
+    for message in anomaly_messages:
+        if message is not None and message[2] is not None:
+            png = next(images_png)
+            message = message[:2] + (BytesIO(png) if png else None,) + message[3:]
+        rendered.append(message)
+    return rendered
 
 
 def send_email(anomaly_messages, tables):
@@ -576,12 +589,13 @@ def send_email(anomaly_messages, tables):
                 if message is None:
                     continue
                 # Add image to email
-                img_data = message[2].getvalue()
-                img = MIMEImage(img_data, 'png')
-                img.add_header('Content-ID', f'<anomaly_graph_{n}>')  # Content-ID for inline images
-                img.add_header('Content-Disposition', 'inline', filename=f'anomaly_graph_{n}.png')
-                msg.attach(img)
-                html_content += f"<img src='cid:anomaly_graph_{n}'><br>"
+                if message[2] is not None:
+                    img_data = message[2].getvalue()
+                    img = MIMEImage(img_data, 'png')
+                    img.add_header('Content-ID', f'<anomaly_graph_{n}>')  # Content-ID for inline images
+                    img.add_header('Content-Disposition', 'inline', filename=f'anomaly_graph_{n}.png')
+                    msg.attach(img)
+                    html_content += f"<img src='cid:anomaly_graph_{n}'><br>"
                 html_content += f"<a href='{message[3]}'>Open Interactive Graph</a><br>"
                 # Add text to email
                 html_content += f"{message[0]}"
@@ -610,24 +624,28 @@ def send_email(anomaly_messages, tables):
 
 async def main():
     # Script will run in background with asyncio and repeat as per user's "Frequency" (in days) environment variable (86400 = 1 day) 
-    while True:
-        days = os.getenv('Frequency', '1')
-        try:
-            days = int(days)
-        except ValueError:
-            days = 1
-            logging.warning("'Frequency' variable must have a valid numeric input, defaulting to frequency of 1 day.")
-        try:
-            if EMAIL_ADDRESS:
-                await perform_anomaly_check()
-            else:
-                logging.info(f"Anomaly detection is not running, please provide an email address and other relevant environment variables... ")
-            await asyncio.sleep(86400 * days) # Repeat every n days
-        except asyncio.CancelledError:
-            break
-        except Exception as e:
-            logging.error(f"Error in main loop: {e}")
-            await asyncio.sleep(86400 * days)
+    try:
+        while True:
+            days = os.getenv('Frequency', '1')
+            try:
+                days = int(days)
+            except ValueError:
+                days = 1
+                logging.warning("'Frequency' variable must have a valid numeric input, defaulting to frequency of 1 day.")
+            try:
+                if EMAIL_ADDRESS:
+                    await perform_anomaly_check()
+                else:
+                    logging.info(f"Anomaly detection is not running, please provide an email address and other relevant environment variables... ")
+                await asyncio.sleep(86400 * days) # Repeat every n days
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logging.error(f"Error in main loop: {e}")
+                await asyncio.sleep(86400 * days)
+    finally:
+        await connectors.close_pools()
+        await http_client.close_session()
 
 
 if __name__ == "__main__":
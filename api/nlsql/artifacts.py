@@ -0,0 +1,197 @@
+import asyncio
+import gzip
+import hashlib
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Union
+
+from . import metrics
+from .config import get_int_env, get_number_env
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Generated files (charts, reports) served by nginx under /bot/static/. Each file goes into one of 256 subdirectories
+# named after the first byte of the hash of its name, so no directory grows past a few thousand entries, and its
+# creation time and size are recorded in a SQLite index shared by every process of the host. A sweeper deletes files
+# older than ArtifactTTL and, oldest first, the files over ArtifactMaxBytes.
+STATIC_DIR = '/var/www/html/bot/static'
+# Files worth a precompressed sidecar, the other formats are compressed already
+COMPRESSIBLE = ('.html', '.csv', '.js', '.json', '.svg')
+_SIDECARS = {'gzip': '.gz', 'br': '.br'}
+
+_local = threading.local()
+_sweeper: Union[asyncio.Task, None] = None
+_brotli_warned = False
+
+
+def relative(name: str) -> str:
+    """Path of the file name below STATIC_DIR, it is also its path below /bot/static/ in URLs"""
+    return '{}/{}'.format(hashlib.sha1(name.encode()).hexdigest()[:2], name)
+
+
+def path(relative_name: str) -> str:
+    """Absolute path of a file below STATIC_DIR, its directory is created when missing"""
+    file_path = os.path.join(STATIC_DIR, relative_name)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    return file_path
+
+
+def url(relative_name: str) -> str:
+    return '{}/bot/static/{}'.format(os.getenv('StaticEndPoint'), relative_name)
+
+
+def _connect() -> sqlite3.Connection:
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(os.getenv('ArtifactIndexPath', '/tmp/nlsql-artifacts.sqlite3'), timeout=10,
+                               isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS artifacts (name TEXT PRIMARY KEY, size INTEGER, created_at REAL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS artifacts_created_at ON artifacts (created_at)')
+        _local.conn = conn
+    return conn
+
+
+def record(relative_name: str):
+    """Add a complete file to the index, a file already indexed counts as created now"""
+    try:
+        size = os.path.getsize(os.path.join(STATIC_DIR, relative_name))
+        _connect().execute('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?)', (relative_name, size, time.time()))
+    except (OSError, sqlite3.Error) as e:
+        logging.warning(f"Can't record {relative_name} in the artifact index: {e}")
+
+
+def _remove_file(relative_name: str):
+    for suffix in ('',) + tuple(_SIDECARS.values()):
+        try:
+            os.remove(os.path.join(STATIC_DIR, relative_name + suffix))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning(f"Can't remove {relative_name + suffix}: {e}")
+
+
+def remove(relative_name: str):
+    _remove_file(relative_name)
+    try:
+        _connect().execute('DELETE FROM artifacts WHERE name = ?', (relative_name,))
+    except sqlite3.Error as e:
+        logging.warning(f"Can't remove {relative_name} from the artifact index: {e}")
+
+
+def _sidecar_formats() -> List[str]:
+    global _brotli_warned
+
+    formats = [el.strip() for el in os.getenv('ArtifactSidecars', 'gzip').lower().split(',')]
+    if 'br' in formats and brotli is None and not _brotli_warned:
+        logging.warning("'ArtifactSidecars' includes br but the brotli package is not installed")
+        _brotli_warned = True
+    return [el for el in formats if el == 'gzip' or (el == 'br' and brotli is not None)]
+
+
+def write_sidecars(relative_name: str):
+    """Write <name>.gz (and <name>.br) next to a complete file for nginx' gzip_static (and brotli_static).
+
+    The sidecars count towards the file's size in the index and are deleted with it.
+    """
+    try:
+        file_path = os.path.join(STATIC_DIR, relative_name)
+        with open(file_path, 'rb') as f:
+            content = f.read()
+        size = 0
+        for fmt in _sidecar_formats():
+            compressed = gzip.compress(content, 6) if fmt == 'gzip' else brotli.compress(content, quality=9)
+            sidecar = file_path + _SIDECARS[fmt]
+            part = '{}.{}.part'.format(sidecar, secrets.token_hex(4))
+            with open(part, 'wb') as f:
+                f.write(compressed)
+            os.replace(part, sidecar)
+            size += len(compressed)
+        if size:
+            _connect().execute('UPDATE artifacts SET size = size + ? WHERE name = ?', (size, relative_name))
+    except (OSError, sqlite3.Error) as e:
+        logging.warning(f"Can't write the compressed copies of {relative_name}: {e}")
+
+
+def compress_later(*relative_names: str):
+    """Write the sidecars of the compressible files in the loop's default executor, without waiting for them"""
+    if not _sidecar_formats():
+        return
+    loop = asyncio.get_event_loop()
+    for relative_name in relative_names:
+        if os.path.splitext(relative_name)[1].lower() in COMPRESSIBLE:
+            loop.run_in_executor(None, write_sidecars, relative_name)
+
+
+def sweep() -> Dict[str, int]:
+    """Delete the files past ArtifactTTL and over ArtifactMaxBytes, return the number of files deleted for each"""
+    ttl = get_number_env('ArtifactTTL', 7 * 86400)
+    max_bytes = get_int_env('ArtifactMaxBytes', 0)
+    conn = _connect()
+    swept = {}
+    # the rows are taken in one write transaction, concurrent sweepers of other workers find them gone
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        if ttl:
+            expired_at = time.time() - ttl
+            swept['ttl'] = conn.execute('SELECT name, size FROM artifacts WHERE created_at <= ?',
+                                        (expired_at,)).fetchall()
+            conn.execute('DELETE FROM artifacts WHERE created_at <= ?', (expired_at,))
+        if max_bytes:
+            swept['quota'] = conn.execute('SELECT name, size FROM (SELECT name, size, SUM(size) OVER '
+                                          '(ORDER BY created_at DESC) AS total FROM artifacts) WHERE total > ?',
+                                          (max_bytes,)).fetchall()
+            conn.executemany('DELETE FROM artifacts WHERE name = ?', [(name,) for name, _ in swept['quota']])
+        files, total = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM artifacts').fetchone()
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    metrics.ARTIFACT_FILES.set(files)
+    metrics.ARTIFACT_BYTES.set(total)
+    for reason, rows in swept.items():
+        for name, _ in rows:
+            _remove_file(name)
+        metrics.ARTIFACTS_SWEPT.labels(reason).inc(len(rows))
+        metrics.ARTIFACT_BYTES_SWEPT.labels(reason).inc(sum(size for _, size in rows))
+    return {reason: len(rows) for reason, rows in swept.items()}
+
+
+async def _sweep_forever(interval: float):
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            swept = await loop.run_in_executor(None, sweep)
+            if any(swept.values()):
+                logging.info(f"Artifact sweep deleted {swept}")
+        except Exception as e:
+            logging.warning(f"Artifact sweep failed: {e}")
+        await asyncio.sleep(interval)
+
+
+def start_sweeper():
+    """Sweep every ArtifactSweepInterval seconds on the running loop (0 never sweeps)"""
+    global _sweeper
+
+    interval = get_number_env('ArtifactSweepInterval', 600)
+    if interval > 0 and _sweeper is None:
+        _sweeper = asyncio.ensure_future(_sweep_forever(interval))
+
+
+async def stop_sweeper():
+    global _sweeper
+
+    if _sweeper is not None:
+        _sweeper.cancel()
+        try:
+            await _sweeper
+        except asyncio.CancelledError:
+            pass
+        _sweeper = None
@@ -0,0 +1,80 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Tuple, Union
+
+
+class TTLCache:
+    """LRU cache whose entries expire ttl seconds after they were stored.
+
+    The cache is bounded by entry count (maxsize) and/or by the total size of its values (max_bytes); a bound of 0
+    is not applied. With both bounds at 0 the cache is disabled: every get is a miss and set is a no-op.
+    Entries found expired on lookup are counted as stale (and as misses).
+    """
+
+    def __init__(self, maxsize: int, ttl: float, max_bytes: int = 0):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self._data: 'OrderedDict[Hashable, Tuple[float, object, int]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0 or self.max_bytes > 0
+
+    def get(self, key: Hashable, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value, size = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self.bytes -= size
+                self.stale += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value, ttl: Union[float, None] = None, size: int = 0):
+        if not self.enabled or ttl == 0 or (self.max_bytes and size > self.max_bytes):
+            return
+        with self._lock:
+            previous = self._data.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[2]
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value, size)
+            self.bytes += size
+            while (self.maxsize and len(self._data) > self.maxsize) or (self.max_bytes and self.bytes > self.max_bytes):
+                _, (_, _, evicted_size) = self._data.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'size': len(self._data),
+                    'bytes': self.bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'stale': self.stale,
+                    'evictions': self.evictions}
@@ -0,0 +1,68 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Tuple, Union
+
+from . import artifacts, graph, render
+from .columnar import ColumnarResult
+from .config import get_number_env
+
+# Chart files are named after a fingerprint of what they show (the graph function, the data and every option), so a
+# chart already rendered by any worker of this host is answered with its existing files instead of being rendered
+# again. The files may already be linked in chat, so they are only ever deleted by the artifact sweeper (see
+# artifacts.sweep), which also bounds their disk use.
+
+
+def _plain(o):
+    # JSON stand-in for the values of a query result, tagged with their type so that e.g. 1 and Decimal('1') differ
+    if isinstance(o, ColumnarResult):
+        return ['ColumnarResult', o.names, o.columns]
+    if hasattr(o, 'to_dict'):
+        # pandas DataFrame of a map
+        return [type(o).__name__, o.to_dict('split')]
+    if hasattr(o, 'tolist'):
+        # numpy arrays and scalars
+        return o.tolist()
+    return [type(o).__name__, str(o)]
+
+
+def fingerprint(func, args, kwargs) -> Union[str, None]:
+    """Stable hash of the chart func(*args, **kwargs) draws, None when its input can't be fingerprinted"""
+    try:
+        payload = json.dumps([func.__module__, func.__name__, graph.plotlyjs_mode(), args, sorted(kwargs.items())],
+                             default=_plain, separators=(',', ':'))
+    except (TypeError, ValueError) as e:
+        logging.info(f"Chart is not cached: {e}")
+        return None
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+
+def _fresh(names: Tuple[str, str], ttl: float) -> bool:
+    # Both chart files exist and were written at most ttl seconds ago
+    try:
+        stats = [os.stat(os.path.join(artifacts.STATIC_DIR, name)) for name in names]
+    except OSError:
+        return False
+    return all(time.time() - st.st_mtime <= ttl for st in stats)
+
+
+async def build(func, *args, **kwargs):
+    """Chart files (name_html, name_jpg) of the graph function func(*args, **kwargs), rendered in the render pool
+    unless identical files already exist"""
+    ttl = get_number_env('ChartCacheTTL', 86400)
+    key = fingerprint(func, args, kwargs) if ttl > 0 else None
+    if key is None:
+        result = await render.run(func, *args, **kwargs)
+        if isinstance(result, tuple):
+            artifacts.compress_later(*result)
+        return result
+    names = (artifacts.relative('pio_{}.html'.format(key)), artifacts.relative('pio_{}.jpg'.format(key)))
+    # files older than ChartCacheTTL are rendered again in place
+    if _fresh(names, ttl):
+        return names
+    result = await render.run(func, *args, file_name=key, **kwargs)
+    if result == names:
+        artifacts.compress_later(*names)
+    return result
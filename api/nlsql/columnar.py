@@ -0,0 +1,51 @@
+from typing import Iterator, List, Tuple, Union
+
+
+class ColumnarResult:
+    """Query result held column by column: the column names and one list of values per column.
+
+    It also behaves as the sequence of row tuples the row-based code expects (len, indexing, slicing, iteration and
+    an in-place reverse), so it can be passed wherever a fetchall() list was.
+    """
+
+    __slots__ = ('names', 'columns')
+
+    def __init__(self, names: List[str], columns: List[List]):
+        self.names = names
+        self.columns = columns
+
+    @classmethod
+    def from_rows(cls, names: List[str], rows) -> 'ColumnarResult':
+        columns = [list(column) for column in zip(*rows)]
+        return cls(names, columns or [[] for _ in names])
+
+    @classmethod
+    def from_arrow(cls, table) -> 'ColumnarResult':
+        return cls(list(table.column_names), [table.column(i).to_pylist() for i in range(table.num_columns)])
+
+    def column(self, key: Union[int, str]) -> List:
+        return self.columns[key if isinstance(key, int) else self.names.index(key)]
+
+    def rows(self) -> List[Tuple]:
+        return list(zip(*self.columns))
+
+    def copy(self) -> 'ColumnarResult':
+        return ColumnarResult(list(self.names), [list(column) for column in self.columns])
+
+    def reverse(self):
+        for column in self.columns:
+            column.reverse()
+
+    def __len__(self) -> int:
+        return len(self.columns[0]) if self.columns else 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(zip(*(column[index] for column in self.columns)))
+        return tuple(column[index] for column in self.columns)
+
+    def __iter__(self) -> Iterator[Tuple]:
+        return zip(*self.columns)
+
+    def __repr__(self) -> str:
+        return f'ColumnarResult(names={self.names}, rows={len(self)})'
@@ -0,0 +1,15 @@
+import logging
+import os
+
+
+def get_number_env(name: str, default: float) -> float:
+    value = os.getenv(name, '')
+    try:
+        return float(value) if value else default
+    except ValueError:
+        logging.warning(f"'{name}' variable must have a valid numeric input, defaulting to {default}.")
+        return default
+
+
+def get_int_env(name: str, default: int) -> int:
+    return int(get_number_env(name, default))
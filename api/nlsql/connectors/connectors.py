@@ -1,9 +1,17 @@
 import os
 import asyncio
+import re
+import sys
+import functools
+import inspect
+import logging
 import ssl
 import struct
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
-from typing import Dict, List, Union
+from typing import Dict, List, Tuple, Union
 
 import snowflake.connector
 import redshift_connector
@@ -12,76 +20,168 @@ import aiomysql
 import aiopg
 from google.cloud import bigquery
 from google.oauth2 import service_account
+from azure.core.credentials import AccessToken
 from azure.identity import DefaultAzureCredential
 
+from .. import metrics
+from ..cache import TTLCache
+from ..columnar import ColumnarResult
+from ..config import get_int_env, get_number_env
+from . import dialects
+
 DEBUG = True if os.getenv('DEBUG', '') == '1' else False
 
+# Scopes of the Azure AD access tokens used instead of DbPassword
+AD_SCOPE_MSSQL = "https://database.windows.net/.default"
+AD_SCOPE_OSSRDBMS = "https://ossrdbms-aad.database.windows.net/.default"
+# Cached tokens are refreshed in the background this many seconds before they expire
+AD_TOKEN_REFRESH_MARGIN = 5 * 60
+# A cached token closer than this to expiry is not handed out any more, callers wait for the refresh
+AD_TOKEN_MIN_VALIDITY = 60
+
+# Drivers without an asyncio API, every blocking call of theirs goes through run_sync
+SYNC_DRIVERS = ('snowflake', 'redshift', 'bigquery')
+
+_executor: Union[ThreadPoolExecutor, None] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=get_int_env('DbThreadPoolSize', 8),
+                                       thread_name_prefix='nlsql-db')
+    return _executor
+
+
+async def run_sync(func, *args, **kwargs):
+    """Run a blocking driver call in the size-bounded db thread pool without blocking the event loop"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_get_executor(), functools.partial(func, *args, **kwargs))
+
+
+def _fetchall(conn, sql, params=None) -> List:
+    cursor = conn.cursor()
+    try:
+        if params:
+            cursor.execute(sql, params)
+        else:
+            cursor.execute(sql)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def _bigquery_fetchall(conn, sql, params=None) -> List:
+    job_config = bigquery.QueryJobConfig(query_parameters=params) if params else None
+    query_job = conn.query(sql, job_config=job_config)
+    return list(query_job.result())
+
 
-async def get_ad_token(kwargs: Dict, url="https://database.windows.net/.default") -> str:
-    # Set up Azure Active Directory authentication
-    if kwargs['ClientIdOfUserAssignedIdentity']:
-        credential = DefaultAzureCredential(
-            managed_identity_client_id=kwargs['ClientIdOfUserAssignedIdentity'])  # user-assigned identity
+async def _execute(db, cursor, sql, params=None):
+    if not params:
+        await cursor.execute(sql)
+    elif db == 'mssql':
+        # aioodbc takes the parameters positionally
+        await cursor.execute(sql, *params)
     else:
-        if DEBUG:
-            print("get credential")
-        credential = DefaultAzureCredential()  # system-assigned identity
-        if DEBUG:
-            print(f"credential={credential}")
+        await cursor.execute(sql, params)
+
+
+# Process-wide Azure AD token cache keyed by (scope, client id of the user-assigned identity)
+_ad_credentials: Dict[str, DefaultAzureCredential] = {}
+_ad_tokens: Dict[Tuple[str, str], AccessToken] = {}
+_ad_token_refreshes: Dict[Tuple[str, str], asyncio.Future] = {}
+
+
+def _get_ad_token_sync(url: str, client_id: str) -> AccessToken:
+    # Set up Azure Active Directory authentication, the credential is reused for every refresh
+    credential = _ad_credentials.get(client_id)
+    if credential is None:
+        if client_id:
+            credential = DefaultAzureCredential(managed_identity_client_id=client_id)  # user-assigned identity
+        else:
+            if DEBUG:
+                print("get credential")
+            credential = DefaultAzureCredential()  # system-assigned identity
+            if DEBUG:
+                print(f"credential={credential}")
+        _ad_credentials[client_id] = credential
 
     # Get the access token for Azure SQL
     if DEBUG:
         print("get token")
     token = credential.get_token(url)
     if DEBUG:
-        print(f"token={token}")
-    token = token.token
+        print(f"token expires_on={token.expires_on}")
     return token
 
 
-async def get_connector(db, **kwargs):
-    conn = ''
-    if db == 'snowflake':
-        conn = snowflake.connector.connect(
-            account=kwargs['Account'],
-            warehouse=kwargs['Warehouse'],
-            database=kwargs['DbName'],
-            schema=kwargs['DbSchema'],
-            user=kwargs['DbUser'],
-            password=kwargs['DbPassword']
-        )
-    elif db == 'redshift':
-        conn = redshift_connector.connect(
-            host=kwargs['DataSource'],
-            database=kwargs['DbName'],
-            user=kwargs['DbUser'],
-            password=kwargs['DbPassword'],
-            client_protocol_version=1
-        )
-    elif db == 'mssql':
+def _refresh_ad_token(key: Tuple[str, str]) -> asyncio.Future:
+    """Start (or join) the single in-flight token request for the key"""
+    refresh = _ad_token_refreshes.get(key)
+    if refresh is None:
+        refresh = asyncio.ensure_future(run_sync(_get_ad_token_sync, *key))
+        _ad_token_refreshes[key] = refresh
+
+        def _done(future: asyncio.Future):
+            _ad_token_refreshes.pop(key, None)
+            if future.cancelled():
+                return
+            if future.exception() is not None:
+                logging.error(f"Failed to refresh Azure AD token for {key[0]}: {future.exception()}")
+            else:
+                _ad_tokens[key] = future.result()
+
+        refresh.add_done_callback(_done)
+    return refresh
+
+
+async def get_ad_token(kwargs: Dict, url=AD_SCOPE_MSSQL) -> str:
+    key = (url, kwargs['ClientIdOfUserAssignedIdentity'] or '')
+    token = _ad_tokens.get(key)
+    expires_in = token.expires_on - time.time() if token else 0
+    if expires_in < AD_TOKEN_MIN_VALIDITY:
+        # IMDS / managed-identity probing runs in the db thread pool, the loop keeps serving other messages
+        token = await asyncio.shield(_refresh_ad_token(key))
+    elif expires_in < AD_TOKEN_REFRESH_MARGIN:
+        # Still valid: hand it out and refresh in the background
+        _refresh_ad_token(key)
+    return token.token
+
+
+async def _get_connect_args(db, kwargs: Dict, ad_token=None) -> Dict:
+    """Keyword arguments for aioodbc / aiomysql / aiopg, shared by single connections and pools.
+
+    Connections run in autocommit mode so a pooled connection never keeps a read transaction (and its snapshot) open
+    between messages. ad_token is used instead of fetching an Azure AD token when given.
+    """
+    if db == 'mssql':
         driver = "{ODBC Driver 17 for SQL Server}"
         if DEBUG:
             print(f"{kwargs['ActiveDirectoryAuthentication']}")
             print(f"{kwargs['ClientIdOfUserAssignedIdentity']}")
         if kwargs['ActiveDirectoryAuthentication'] or kwargs['ClientIdOfUserAssignedIdentity']:
-            token = await get_ad_token(kwargs)
+            token = ad_token or await get_ad_token(kwargs, url=AD_SCOPE_MSSQL)
             token = token.encode("UTF-16-LE")
             token_struct = struct.pack(f'<I{len(token)}s', len(token), token)
 
             # Set up the connection string
             SQL_COPT_SS_ACCESS_TOKEN = 1256
             connection_string = f"DRIVER={driver};SERVER={kwargs['DataSource']};DATABASE={kwargs['DbName']}"
-            return await aioodbc.connect(dsn=connection_string, attrs_before={SQL_COPT_SS_ACCESS_TOKEN: token_struct})
-
-        conn = await aioodbc.connect(dsn='DRIVER={0};'
-                                         'SERVER={1};'
-                                         'DATABASE={2};'
-                                         'UID={3};'
-                                         'PWD={4}'.format(driver,
-                                                          kwargs['DataSource'],
-                                                          kwargs['DbName'],
-                                                          kwargs['DbUser'],
-                                                          kwargs['DbPassword']))
+            return {'dsn': connection_string, 'attrs_before': {SQL_COPT_SS_ACCESS_TOKEN: token_struct},
+                    'autocommit': True}
+
+        return {'dsn': 'DRIVER={0};'
+                       'SERVER={1};'
+                       'DATABASE={2};'
+                       'UID={3};'
+                       'PWD={4}'.format(driver,
+                                        kwargs['DataSource'],
+                                        kwargs['DbName'],
+                                        kwargs['DbUser'],
+                                        kwargs['DbPassword']),
+                'autocommit': True}
     elif db == 'mysql':
         if not kwargs['DbPort']:
             kwargs['DbPort'] = 3306
@@ -91,41 +191,66 @@ async def get_connector(db, **kwargs):
             ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
 
         if kwargs['ActiveDirectoryAuthentication'] or kwargs['ClientIdOfUserAssignedIdentity']:
-            token = await get_ad_token(kwargs, url="https://ossrdbms-aad.database.windows.net/.default")
+            token = ad_token or await get_ad_token(kwargs, url=AD_SCOPE_OSSRDBMS)
 
             # Connect with the token
             os.environ['LIBMYSQL_ENABLE_CLEARTEXT_PLUGIN'] = '1'
 
-            return await aiomysql.connect(host=kwargs['DataSource'],
-                                          user=kwargs['DbUser'],
-                                          password=token,
-                                          db=kwargs['DbName'],
-                                          port=int(kwargs['DbPort']),
-                                          ssl=ssl_context)
-
-        conn = await aiomysql.connect(host=kwargs['DataSource'],
-                                      user=kwargs['DbUser'],
-                                      password=kwargs['DbPassword'],
-                                      db=kwargs['DbName'],
-                                      port=int(kwargs['DbPort']),
-                                      ssl=ssl_context)
+            return {'host': kwargs['DataSource'],
+                    'user': kwargs['DbUser'],
+                    'password': token,
+                    'db': kwargs['DbName'],
+                    'port': int(kwargs['DbPort']),
+                    'ssl': ssl_context,
+                    'autocommit': True}
+
+        return {'host': kwargs['DataSource'],
+                'user': kwargs['DbUser'],
+                'password': kwargs['DbPassword'],
+                'db': kwargs['DbName'],
+                'port': int(kwargs['DbPort']),
+                'ssl': ssl_context,
+                'autocommit': True}
     elif db == 'postgresql':
         if not kwargs['DbPort']:
             kwargs['DbPort'] = 5432
         if kwargs['ActiveDirectoryAuthentication'] or kwargs['ClientIdOfUserAssignedIdentity']:
-            token = await get_ad_token(kwargs, url="https://ossrdbms-aad.database.windows.net/.default")
-
-            return await aiopg.connect(host=kwargs['DataSource'],
-                                       user=kwargs['DbUser'],
-                                       password=token,
-                                       database=kwargs['DbName'],
-                                       port=int(kwargs['DbPort']))
-
-        conn = await aiopg.connect(host=kwargs['DataSource'],
-                                   user=kwargs['DbUser'],
-                                   password=kwargs['DbPassword'],
-                                   database=kwargs['DbName'],
-                                   port=int(kwargs['DbPort']))
+            token = ad_token or await get_ad_token(kwargs, url=AD_SCOPE_OSSRDBMS)
+
+            return {'host': kwargs['DataSource'],
+                    'user': kwargs['DbUser'],
+                    'password': token,
+                    'database': kwargs['DbName'],
+                    'port': int(kwargs['DbPort'])}
+
+        return {'host': kwargs['DataSource'],
+                'user': kwargs['DbUser'],
+                'password': kwargs['DbPassword'],
+                'database': kwargs['DbName'],
+                'port': int(kwargs['DbPort'])}
+    return {}
+
+
+def _connect_sync(db, kwargs: Dict):
+    conn = ''
+    if db == 'snowflake':
+        conn = snowflake.connector.connect(
+            account=kwargs['Account'],
+            warehouse=kwargs['Warehouse'],
+            database=kwargs['DbName'],
+            schema=kwargs['DbSchema'],
+            user=kwargs['DbUser'],
+            password=kwargs['DbPassword']
+        )
+    elif db == 'redshift':
+        conn = redshift_connector.connect(
+            host=kwargs['DataSource'],
+            database=kwargs['DbName'],
+            user=kwargs['DbUser'],
+            password=kwargs['DbPassword'],
+            client_protocol_version=1
+        )
+        conn.autocommit = True
     elif db == 'bigquery':
         if os.getenv('DEBUG', '') == '1':
             print(kwargs['private_key'])
@@ -142,6 +267,305 @@ async def get_connector(db, **kwargs):
     return conn
 
 
+async def get_connector(db, **kwargs):
+    conn = ''
+    if db in SYNC_DRIVERS:
+        conn = await run_sync(_connect_sync, db, kwargs)
+    elif db == 'mssql':
+        conn = await aioodbc.connect(**await _get_connect_args(db, kwargs))
+    elif db == 'mysql':
+        conn = await aiomysql.connect(**await _get_connect_args(db, kwargs))
+    elif db == 'postgresql':
+        conn = await aiopg.connect(**await _get_connect_args(db, kwargs))
+    return conn
+
+
+async def close_connection(db, conn):
+    if db in ['mssql', 'postgresql']:
+        await conn.close()
+    elif db in SYNC_DRIVERS:
+        await run_sync(conn.close)
+    else:
+        conn.close()
+
+
+def _ping_sync(db, conn) -> bool:
+    if db == 'bigquery':
+        # stateless HTTP client, nothing to check
+        return True
+    if db == 'snowflake' and conn.is_closed():
+        return False
+    _fetchall(conn, 'SELECT 1')
+    return True
+
+
+async def _ping(db, conn) -> bool:
+    try:
+        if db in SYNC_DRIVERS:
+            return await run_sync(_ping_sync, db, conn)
+        async with conn.cursor() as cursor:
+            await cursor.execute('SELECT 1')
+            await cursor.fetchall()
+        return True
+    except Exception as e:
+        logging.info(f"Dropping dead {db} connection: {e}")
+        return False
+
+
+class SyncConnectionPool:
+    """Bounded pool for the blocking drivers (snowflake, redshift, bigquery)"""
+
+    def __init__(self, db: str, params: Dict, minsize: int, maxsize: int, idle_timeout: float,
+                 ping_interval: float):
+        self.db = db
+        self.params = params
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.ping_interval = ping_interval
+        self.ad_token = None
+        self.closed = False
+        self._free: List[Tuple[object, float]] = []
+        self._size = 0
+        self._cond = asyncio.Condition()
+        self.in_use = set()
+
+    async def acquire(self):
+        while True:
+            async with self._cond:
+                await self._cond.wait_for(lambda: self._free or self._size < self.maxsize)
+                if self._free:
+                    conn, last_used = self._free.pop()
+                else:
+                    self._size += 1
+                    conn, last_used = None, None
+            if conn is None:
+                try:
+                    conn = await get_connector(self.db, **self.params)
+                except Exception:
+                    await self._forget()
+                    raise
+                self.in_use.add(conn)
+                return conn
+            # Health check on checkout, skipped for connections used a moment ago
+            if time.monotonic() - last_used < self.ping_interval or await _ping(self.db, conn):
+                self.in_use.add(conn)
+                return conn
+            await self._discard(conn)
+
+    async def release(self, conn, discard=False):
+        self.in_use.discard(conn)
+        if discard or self.closed:
+            return await self._discard(conn)
+        async with self._cond:
+            self._free.append((conn, time.monotonic()))
+            self._cond.notify()
+        await self._evict_idle()
+
+    async def close(self):
+        self.closed = True
+        async with self._cond:
+            free, self._free = self._free, []
+        for conn, _ in free:
+            await self._discard(conn)
+
+    async def wait_closed(self):
+        pass
+
+    async def _evict_idle(self):
+        now = time.monotonic()
+        async with self._cond:
+            idle = [el for el in self._free if now - el[1] > self.idle_timeout]
+            idle = idle[:max(0, self._size - self.minsize)]
+            self._free = [el for el in self._free if el not in idle]
+        for conn, _ in idle:
+            await self._discard(conn)
+
+    async def _discard(self, conn):
+        try:
+            await close_connection(self.db, conn)
+        except Exception as e:
+            logging.info(f"Failed to close {self.db} connection: {e}")
+        await self._forget()
+
+    async def _forget(self):
+        async with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+
+class AsyncConnectionPool:
+    """aiomysql / aiopg / aioodbc pool with a health check on checkout"""
+
+    def __init__(self, db: str, pool, ping_interval: float):
+        self.db = db
+        self.ad_token = None
+        self.closed = False
+        self.ping_interval = ping_interval
+        self._pool = pool
+        self._last_used = weakref.WeakKeyDictionary()
+        self.in_use = set()
+
+    async def acquire(self):
+        while True:
+            conn = await self._pool.acquire()
+            last_used = self._last_used.pop(conn, None)
+            if last_used is None or time.monotonic() - last_used < self.ping_interval or await _ping(self.db, conn):
+                self.in_use.add(conn)
+                return conn
+            await self.release(conn, discard=True)
+
+    async def release(self, conn, discard=False):
+        self.in_use.discard(conn)
+        if discard:
+            try:
+                await close_connection(self.db, conn)
+            except Exception as e:
+                logging.info(f"Failed to close {self.db} connection: {e}")
+        else:
+            self._last_used[conn] = time.monotonic()
+        released = self._pool.release(conn)
+        if inspect.isawaitable(released):
+            await released
+
+    async def close(self):
+        # in-use connections are closed by the driver pool once they are released
+        self.closed = True
+        self._pool.close()
+
+    async def wait_closed(self):
+        await self._pool.wait_closed()
+
+
+_pools: Dict[str, Union[SyncConnectionPool, AsyncConnectionPool]] = {}
+_pools_loop: Union[asyncio.AbstractEventLoop, None] = None
+_pools_lock: Union[asyncio.Lock, None] = None
+# Closed pools with the task closing their connections, kept until that is done and every checked-out connection
+# came back
+_retired: Dict[Union[SyncConnectionPool, AsyncConnectionPool], asyncio.Future] = {}
+
+
+def _uses_ad_token(db, kwargs: Dict) -> bool:
+    return db in ['mssql', 'mysql', 'postgresql'] and bool(kwargs.get('ActiveDirectoryAuthentication')
+                                                           or kwargs.get('ClientIdOfUserAssignedIdentity'))
+
+
+async def _create_pool(db, kwargs: Dict, ad_token=None) -> Union[SyncConnectionPool, AsyncConnectionPool]:
+    minsize = get_int_env('DbPoolMinSize', 1)
+    maxsize = get_int_env('DbPoolMaxSize', 10)
+    minsize = min(minsize, maxsize)
+    idle_timeout = get_number_env('DbPoolIdleTimeout', 300)
+    ping_interval = get_number_env('DbPoolPingInterval', 30)
+    if db in SYNC_DRIVERS:
+        return SyncConnectionPool(db, dict(kwargs), minsize, maxsize, idle_timeout, ping_interval)
+
+    connect_args = await _get_connect_args(db, dict(kwargs), ad_token=ad_token)
+    # pool_recycle closes connections idle for longer than idle_timeout on the next checkout
+    if db == 'mssql':
+        pool = await aioodbc.create_pool(minsize=minsize, maxsize=maxsize, pool_recycle=idle_timeout,
+                                         **connect_args)
+    elif db == 'mysql':
+        pool = await aiomysql.create_pool(minsize=minsize, maxsize=maxsize, pool_recycle=idle_timeout,
+                                          **connect_args)
+    else:
+        pool = await aiopg.create_pool(minsize=minsize, maxsize=maxsize, pool_recycle=idle_timeout,
+                                       **connect_args)
+    return AsyncConnectionPool(db, pool, ping_interval)
+
+
+async def _get_pool(db, kwargs: Dict) -> Union[SyncConnectionPool, AsyncConnectionPool]:
+    global _pools
+    global _pools_loop
+    global _pools_lock
+    global _retired
+
+    loop = asyncio.get_event_loop()
+    if _pools_loop is not loop:
+        # pools are bound to the loop that created them
+        _pools = {}
+        _retired = {}
+        _pools_loop = loop
+        _pools_lock = asyncio.Lock()
+
+    async with _pools_lock:
+        # One token for the comparison and the connections of a new pool
+        ad_token = None
+        if _uses_ad_token(db, kwargs):
+            ad_token = await get_ad_token(kwargs, url=AD_SCOPE_MSSQL if db == 'mssql' else AD_SCOPE_OSSRDBMS)
+        pool = _pools.get(db)
+        if pool is not None and pool.ad_token != ad_token:
+            # New connections need the refreshed token: retire the pool, in-use connections close on release
+            await pool.close()
+            _retire(pool)
+            pool = None
+        if pool is None:
+            pool = await _create_pool(db, kwargs, ad_token)
+            pool.ad_token = ad_token
+            _pools[db] = pool
+    return pool
+
+
+@metrics.timed('db_connect')
+async def acquire_connection(db, **kwargs):
+    """Check out a connection from the pool of the given DatabaseType.
+
+    Connects directly when pooling is disabled with DbPoolMaxSize=0. Every acquired connection must be handed back
+    with release_connection.
+    """
+    if get_int_env('DbPoolMaxSize', 10) <= 0:
+        return await get_connector(db, **kwargs)
+
+    pool = await _get_pool(db, kwargs)
+    return await pool.acquire()
+
+
+def _retire(pool: Union[SyncConnectionPool, AsyncConnectionPool]) -> asyncio.Future:
+    # The driver pools close their free connections in wait_closed, which also waits for the checked-out ones
+    task = asyncio.ensure_future(pool.wait_closed())
+    _retired[pool] = task
+    task.add_done_callback(lambda _: _forget_retired(pool))
+    return task
+
+
+def _forget_retired(pool: Union[SyncConnectionPool, AsyncConnectionPool]):
+    task = _retired.get(pool)
+    if task is None or not task.done() or pool.in_use:
+        return
+    del _retired[pool]
+    if not task.cancelled() and task.exception() is not None:
+        logging.warning(f"Failed to close retired {pool.db} pool: {task.exception()}")
+
+
+async def release_connection(db, conn, discard=False):
+    """Return a connection to the pool it was checked out from, or close it when it was connected directly.
+
+    Call it exactly once per acquire_connection, a released connection can be checked out by another request
+    right away.
+    """
+    pools = [pool for pool in [_pools.get(db)] + list(_retired) if pool is not None and conn in pool.in_use]
+    if not pools:
+        if get_int_env('DbPoolMaxSize', 10) > 0:
+            logging.warning(f"Ignoring release of a {db} connection that is not checked out")
+        else:
+            await close_connection(db, conn)
+        return
+    pool = pools[0]
+    await pool.release(conn, discard=discard)
+    _forget_retired(pool)
+
+
+async def close_pools(timeout=10):
+    global _pools
+
+    pools, _pools = list(_pools.values()), {}
+    for pool in pools:
+        await pool.close()
+        try:
+            await asyncio.wait_for(asyncio.shield(_retire(pool)), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Timed out waiting for {pool.db} connections to be released")
+
+
 async def get_db_param(db: str) -> Dict:
     params = {}
     if db == 'snowflake':
@@ -208,100 +632,218 @@ async def get_db_param(db: str) -> Dict:
     return params
 
 
-async def do_query(db, conn, sql, map_mode=False, stacked_bar_mod=False):
+# Query results keyed on (db type, database, normalised SQL, shaping mode), bounded by QueryCacheMaxBytes
+query_cache = TTLCache(maxsize=0, ttl=300, max_bytes=get_int_env('QueryCacheMaxBytes', 0))
+metrics.register_cache('query', query_cache)
+_SQL_LITERALS = re.compile(r"('(?:[^']|'')*')")
+
+
+def _query_cache_ttl(db) -> float:
+    """QueryCacheTTL is either seconds for every data source or e.g. "300,snowflake=900,mssql=60" """
+    ttl = 300.0
+    for el in os.getenv('QueryCacheTTL', '').split(','):
+        name, _, value = el.strip().rpartition('=')
+        try:
+            if not name:
+                ttl = float(value)
+            elif name.strip().lower() == db:
+                return float(value)
+        except ValueError:
+            continue
+    return ttl
+
 
-    if map_mode:
-        result = {"country": [], "value": []}
-    elif stacked_bar_mod:
-        result = {}
+def _normalise_sql(sql: str) -> str:
+    # collapse whitespace outside string literals
+    parts = _SQL_LITERALS.split(sql.strip().rstrip(';'))
+    return ''.join(part if i % 2 else re.sub(r'\s+', ' ', part) for i, part in enumerate(parts))
+
+
+def _sizeof(result) -> int:
+    size = sys.getsizeof(result)
+    if isinstance(result, ColumnarResult):
+        rows = result.columns
     else:
-        result = []
+        rows = result.values() if isinstance(result, dict) else [result]
+    for column in rows:
+        for row in column:
+            size += sys.getsizeof(row)
+            if isinstance(row, (tuple, list)):
+                size += sum(sys.getsizeof(el) for el in row)
+    return size
 
-    if db in ['snowflake', 'redshift']:
-        cursor = conn.cursor()
-        cursor.execute(sql)
-        value: list = cursor.fetchall()
-        if stacked_bar_mod:
-            async for ind in async_range(0, len(value[0])):
-                result.update({f'column{ind + 1}': []})
-        async for i in _words(value):
-            if map_mode:
-                result["country"].append(i[0])
-                result["value"].append(i[1])
-            elif stacked_bar_mod:
-                async for ind in async_range(0, len(i)):
-                    try:
-                        result[f"column{ind + 1}"].append(i[ind])
-                    except KeyError:
-                        result.update({f'column{ind + 1}': []})
-                        result[f"column{ind + 1}"].append(i[ind])
-            else:
-                result.append(i)
+
+def _copy_result(result):
+    # callers reorder and reassign the result in place (e.g. graph.build_html_bar)
+    if isinstance(result, ColumnarResult):
+        return result.copy()
+    if isinstance(result, dict):
+        return {key: list(value) for key, value in result.items()}
+    return list(result)
+
+
+async def _cached_query(db, sql, mode: str, query, params=None):
+    if not query_cache.enabled or not isinstance(sql, str):
+        return await query()
+    key = (db, os.getenv('DataSource', ''), os.getenv('DbName', ''), _normalise_sql(sql), mode,
+           tuple(repr(el) for el in params or ()))
+    result = query_cache.get(key)
+    if result is not None:
+        return _copy_result(result)
+    result = await query()
+    query_cache.set(key, _copy_result(result), ttl=_query_cache_ttl(db), size=_sizeof(result))
+    return result
+
+
+async def do_query(db, conn, sql, map_mode=False, stacked_bar_mod=False, params=None, columnar=False):
+    """Rows of sql as a list of tuples, or a ColumnarResult with columnar=True.
+
+    map_mode returns {"country": [...], "value": [...]} of the first two columns, stacked_bar_mod
+    {"column1": [...], "column2": [...], ...}.
+    """
+    mode = 'map' if map_mode else 'stacked_bar' if stacked_bar_mod else 'columnar' if columnar else 'rows'
+    return await _cached_query(db, sql, mode,
+                               lambda: _do_query(db, conn, sql, map_mode, stacked_bar_mod, params, columnar),
+                               params=params)
+
+
+def _fetch_columns_sync(db, conn, sql, params=None) -> ColumnarResult:
+    if db == 'bigquery':
+        job_config = bigquery.QueryJobConfig(query_parameters=params) if params else None
+        return ColumnarResult.from_arrow(conn.query(sql, job_config=job_config).result().to_arrow())
+    cursor = conn.cursor()
+    try:
+        if params:
+            cursor.execute(sql, params)
+        else:
+            cursor.execute(sql)
+        names = [el[0] for el in cursor.description or []]
+        if db == 'snowflake':
+            try:
+                table = cursor.fetch_arrow_all()
+            except snowflake.connector.errors.NotSupportedError:
+                # JSON result format, the rows are still unread
+                return ColumnarResult.from_rows(names, cursor.fetchall())
+            return ColumnarResult.from_arrow(table) if table is not None else ColumnarResult.from_rows(names, [])
+        return ColumnarResult.from_rows(names, cursor.fetchall())
+    finally:
         cursor.close()
-    elif db == 'bigquery':
-        query_job = conn.query(sql)
-        value: bigquery.table.RowIterator = query_job.result()
-        if stacked_bar_mod:
-            async for ind in async_range(0, len(value[0])):
-                result.update({f'column{ind + 1}': []})
-        for i in value:
-            if map_mode:
-                result["country"].append(i.values()[0])
-                result["value"].append(i.values()[1])
-            elif stacked_bar_mod:
-                async for ind in async_range(0, len(i)):
-                    try:
-                        result[f"column{ind + 1}"].append(i[ind])
-                    except KeyError:
-                        result.update({f'column{ind + 1}': []})
-                        result[f"column{ind + 1}"].append(i[ind])
-            else:
-                result.append(i.values())
-    else:
+
+
+async def fetch_columns(db, conn, sql, params=None) -> ColumnarResult:
+    """Result of sql column by column, natively as Arrow where the driver can (Snowflake, BigQuery)"""
+    with metrics.timer('query'):
+        if db in SYNC_DRIVERS:
+            return await run_sync(_fetch_columns_sync, db, conn, sql, params)
         async with conn.cursor() as cursor:
-            await cursor.execute(sql)
-            value = await cursor.fetchall()
-            if stacked_bar_mod:
-                async for ind in async_range(0, len(value[0])):
-                    result.update({f'column{ind + 1}': []})
-            async for i in _words(value):
-                if map_mode:
-                    result["country"].append(i[0])
-                    result["value"].append(i[1])
-                elif stacked_bar_mod:
-                    async for ind in async_range(0, len(i)):
-                        try:
-                            result[f"column{ind+1}"].append(i[ind])
-                        except KeyError:
-                            result.update({f'column{ind + 1}': []})
-                            result[f"column{ind + 1}"].append(i[ind])
-                else:
-                    result.append(i)
-            if db in ['postgresql']:
+            await _execute(db, cursor, sql, params)
+            rows = await cursor.fetchall()
+            names = [el[0] for el in cursor.description or []]
+            if db == 'postgresql':
                 cursor.close()
             elif db != 'mssql':
                 await cursor.close()
+        return ColumnarResult.from_rows(names, rows)
+
+
+async def _do_query(db, conn, sql, map_mode=False, stacked_bar_mod=False, params=None, columnar=False):
+    if map_mode or stacked_bar_mod or columnar:
+        result = await fetch_columns(db, conn, sql, params)
+        with metrics.timer('shaping'):
+            if map_mode:
+                empty = [[], []]
+                country, value = (result.columns + empty)[:2]
+                return {"country": country, "value": value}
+            if stacked_bar_mod:
+                if not len(result):
+                    return {}
+                return {f'column{ind + 1}': column for ind, column in enumerate(result.columns)}
+        return result
+
+    with metrics.timer('query'):
+        if db in ['snowflake', 'redshift']:
+            value: list = await run_sync(_fetchall, conn, sql, params)
+        elif db == 'bigquery':
+            value: list = [row.values() for row in await run_sync(_bigquery_fetchall, conn, sql, params)]
+        else:
+            async with conn.cursor() as cursor:
+                await _execute(db, cursor, sql, params)
+                value = await cursor.fetchall()
+                if db in ['postgresql']:
+                    cursor.close()
+                elif db != 'mssql':
+                    await cursor.close()
+    return list(value)
+
 
+async def do_queries(db, db_param: Dict, queries: Dict, map_mode=False) -> Dict:
+    """Run {key: sql} concurrently, each query on its own pooled connection.
+
+    At most QueryParallelism queries run at once and the whole fan-out, including waiting for connections, is
+    bounded by QueryDeadline seconds (asyncio.TimeoutError). Results keep the key order of queries.
+    """
+    semaphore = asyncio.Semaphore(max(1, get_int_env('QueryParallelism', 4)))
+
+    async def run(sql):
+        async with semaphore:
+            conn = await acquire_connection(db, **db_param)
+            try:
+                result = await do_query(db, conn, sql, map_mode=map_mode)
+            except BaseException:
+                # a failed or cancelled query can leave the connection mid-result
+                await release_connection(db, conn, discard=True)
+                raise
+            await release_connection(db, conn)
+            return result
+
+    results = await asyncio.wait_for(asyncio.gather(*(run(sql) for sql in queries.values())),
+                                     get_number_env('QueryDeadline', 120))
+    return dict(zip(queries, results))
+
+
+async def do_batched_query(db, conn, template: str, elements: List) -> Union[Dict, None]:
+    """Run a per-element template ("... = '{}' ...") for all elements in one statement.
+
+    Returns {element: rows} in the order of elements, like one do_query per element would, or None when the template
+    can't be batched and the caller has to loop over the elements.
+    """
+    sql = dialects.batch_elements_sql(db, template, len(elements))
+    if sql is None:
+        return None
+    params = [str(el) for el in elements]
+    if db == 'bigquery':
+        params = [bigquery.ScalarQueryParameter(f'nlsql_el_{i}', 'STRING', el) for i, el in enumerate(params)]
+
+    rows = await do_query(db, conn, sql, params=params)
+    result = {el: [] for el in elements}
+    for row in rows:
+        result[elements[int(row[0])]].append(tuple(row[1:]))
     return result
 
 
 # round to 2 numbers after . and finally convert response to a single format tuple str like: 1,000.02
 async def do_query_formatting(db, conn, sql):
+    return await _cached_query(db, sql, 'formatted', lambda: _do_query_formatting(db, conn, sql))
+
+
+async def _do_query_formatting(db, conn, sql):
     if db in ['snowflake', 'redshift']:
-        cursor = conn.cursor()
-        cursor.execute(sql)
-        value: List = cursor.fetchall()
-        result = await _parse_cursor_response(value)
-        cursor.close()
+        with metrics.timer('query'):
+            value: List = await run_sync(_fetchall, conn, sql)
+        with metrics.timer('shaping'):
+            result = await _parse_cursor_response(value)
     elif db == 'bigquery':
-        query_job = conn.query(sql)
-        value: bigquery.table.RowIterator = query_job.result()
-        result = await _parse_cursor_response(value)
+        with metrics.timer('query'):
+            value: List[bigquery.table.Row] = await run_sync(_bigquery_fetchall, conn, sql)
+        with metrics.timer('shaping'):
+            result = await _parse_cursor_response(value)
     else:
         async with conn.cursor() as cursor:
-            await cursor.execute(sql)
-            value: List = await cursor.fetchall()
-            result = await _parse_cursor_response(value)
+            with metrics.timer('query'):
+                await cursor.execute(sql)
+                value: List = await cursor.fetchall()
+            with metrics.timer('shaping'):
+                result = await _parse_cursor_response(value)
             if db in ['postgresql']:
                 cursor.close()
             elif db != 'mssql':
@@ -310,41 +852,211 @@ async def do_query_formatting(db, conn, sql):
     return result
 
 
-# subfunction for do_query_formatting
-async def _parse_cursor_response(value: Union[List, bigquery.table.RowIterator]) -> List:
-    result = []
-    if isinstance(value, bigquery.table.RowIterator):
-        for i in value:
-            await _parse_cursor_response_conditional(i, result)
-        return result
+# Streaming: rows are read from a server-side cursor (or the driver's result batches / pages) and handed out in
+# batches of up to QueryBatchSize rows, so only about one batch is held in memory
+_STREAM_CURSOR = 'nlsql_stream'
+# Redshift caps a FETCH on single-node clusters at 1000 rows
+REDSHIFT_MAX_FETCH = 1000
 
-    async for i in _words(value):
-        await _parse_cursor_response_conditional(i, result)
-    return result
 
+async def _iter_mysql(conn, sql, batch_size):
+    # unbuffered cursor: the rows stay on the server until they are fetched
+    cursor = await conn.cursor(aiomysql.SSCursor)
+    try:
+        await cursor.execute(sql)
+        while True:
+            rows = await cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield list(rows)
+    finally:
+        await cursor.close()
 
-# subfunction for _parse_cursor_response
-async def _parse_cursor_response_conditional(i, result: List) -> List:
-    if type(i) == tuple or type(i) == list or isinstance(i, bigquery.table.Row):
-        result.append(tuple([await _formatting_number(el) async for el in _words(i)]))
-    else:
-        result.append(await _formatting_number(i))
 
-    return result
+async def _iter_postgresql(conn, sql, batch_size):
+    # a declared cursor needs a transaction, the connection itself is in autocommit mode
+    async with conn.cursor() as cursor:
+        await cursor.execute('BEGIN')
+        try:
+            await cursor.execute(f'DECLARE {_STREAM_CURSOR} NO SCROLL CURSOR FOR {sql}')
+            while True:
+                await cursor.execute(f'FETCH FORWARD {batch_size} FROM {_STREAM_CURSOR}')
+                rows = await cursor.fetchall()
+                if not rows:
+                    break
+                yield rows
+        finally:
+            # read only, ending the transaction also closes the cursor
+            await cursor.execute('ROLLBACK')
+
+
+async def _iter_mssql(conn, sql, batch_size):
+    async with conn.cursor() as cursor:
+        await cursor.execute(sql)
+        while True:
+            rows = await cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [tuple(row) for row in rows]
+
+
+def _redshift_declare(conn, sql):
+    cursor = conn.cursor()
+    cursor.execute('BEGIN')
+    cursor.execute(f'DECLARE {_STREAM_CURSOR} NO SCROLL CURSOR FOR {sql}')
+    return cursor
+
+
+def _redshift_fetch(cursor, count) -> List:
+    cursor.execute(f'FETCH FORWARD {count} FROM {_STREAM_CURSOR}')
+    return [tuple(row) for row in cursor.fetchall()]
+
+
+def _redshift_close(cursor):
+    try:
+        cursor.execute('ROLLBACK')
+    finally:
+        cursor.close()
+
+
+async def _iter_redshift(conn, sql, batch_size):
+    cursor = await run_sync(_redshift_declare, conn, sql)
+    try:
+        while True:
+            rows = await run_sync(_redshift_fetch, cursor, min(batch_size, REDSHIFT_MAX_FETCH))
+            if not rows:
+                break
+            yield rows
+    finally:
+        await run_sync(_redshift_close, cursor)
+
+
+def _snowflake_batches(conn, sql):
+    cursor = conn.cursor()
+    cursor.execute(sql)
+    return cursor, cursor.get_result_batches() or []
+
+
+def _snowflake_rows(batch) -> List:
+    # downloads one result chunk
+    return [tuple(row) for row in batch]
+
+
+async def _iter_snowflake(conn, sql, batch_size):
+    cursor, batches = await run_sync(_snowflake_batches, conn, sql)
+    try:
+        for batch in batches:
+            yield await run_sync(_snowflake_rows, batch)
+    finally:
+        await run_sync(cursor.close)
+
+
+def _bigquery_pages(conn, sql, batch_size):
+    return iter(conn.query(sql).result(page_size=batch_size).pages)
+
+
+def _bigquery_next_page(pages) -> Union[List, None]:
+    page = next(pages, None)
+    return None if page is None else [tuple(row.values()) for row in page]
+
+
+async def _iter_bigquery(conn, sql, batch_size):
+    pages = await run_sync(_bigquery_pages, conn, sql, batch_size)
+    while True:
+        rows = await run_sync(_bigquery_next_page, pages)
+        if rows is None:
+            break
+        yield rows
+
+
+_ITER_QUERY = {'mysql': _iter_mysql,
+               'postgresql': _iter_postgresql,
+               'mssql': _iter_mssql,
+               'redshift': _iter_redshift,
+               'snowflake': _iter_snowflake,
+               'bigquery': _iter_bigquery}
+
+
+async def iter_query(db, conn, sql: str, batch_size: int = 0):
+    """Rows of sql as lists of tuples, every batch but the last exactly batch_size (QueryBatchSize) rows long.
+
+    Results are neither fully fetched nor cached. A consumer stopping early must aclose() the generator, which
+    closes the cursor.
+    """
+    batch_size = batch_size or max(1, get_int_env('QueryBatchSize', 5000))
+    source = _ITER_QUERY[db](conn, sql.strip().rstrip(';'), batch_size)
+    query_seconds = 0.0
+    batch = []
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                rows = await source.__anext__()
+            except StopAsyncIteration:
+                break
+            finally:
+                query_seconds += time.perf_counter() - start
+            batch.extend(rows)
+            while len(batch) >= batch_size:
+                yield batch[:batch_size]
+                batch = batch[batch_size:]
+        if batch:
+            yield batch
+    finally:
+        await source.aclose()
+        metrics.observe('query', query_seconds)
+
+
+async def iter_query_formatting(db, conn, sql: str, batch_size: int = 0):
+    """iter_query with the values formatted like do_query_formatting"""
+    shaping_seconds = 0.0
+    rows = iter_query(db, conn, sql, batch_size)
+    try:
+        async for batch in rows:
+            start = time.perf_counter()
+            batch = await _parse_cursor_response(batch)
+            shaping_seconds += time.perf_counter() - start
+            yield batch
+    finally:
+        await rows.aclose()
+        metrics.observe('shaping', shaping_seconds)
+
+
+async def format_rows(rows: List) -> List:
+    """Rows of iter_query formatted like do_query_formatting"""
+    return await _parse_cursor_response(rows)
+
+
+# subfunction for do_query_formatting
+async def _parse_cursor_response(value: Union[List, bigquery.table.RowIterator]) -> List:
+    rows = list(value)
+    if not all(_is_row(i) for i in rows) or len({len(i) for i in rows}) > 1:
+        return [tuple(_format_column(i)) if _is_row(i) else _format_number(i) for i in rows]
+    # format column by column, the column's value types decide how
+    columns = [_format_column(column) for column in zip(*rows)]
+    return list(zip(*columns)) if columns else [() for _ in rows]
+
+
+def _is_row(i) -> bool:
+    return type(i) == tuple or type(i) == list or isinstance(i, bigquery.table.Row)
 
 
-async def _words(word):
-    for i in range(len(word)):
-        yield word[i]
+_NUMBER_TYPES = {int, float, Decimal}
+_FORMATTED_TYPES = _NUMBER_TYPES | {str}
+_NUMBER_FORMAT = '{:,.2f}'.format
 
 
-async def async_range(start, length):
-    for i in range(start, length):
-        yield i
+def _format_column(column) -> List:
+    types = set(map(type, column))
+    if types <= _NUMBER_TYPES:
+        return list(map(_NUMBER_FORMAT, column))
+    if not types & _FORMATTED_TYPES:
+        return list(column)
+    return [_format_number(el) for el in column]
 
 
 # input number and formating it like 1,000.02
-async def _formatting_number(el):
+def _format_number(el):
     if type(el) == str and el.replace('.', '').isdigit():
         return f'{float(el):,.2f}'
     if type(el) == int or type(el) == float or type(el) == Decimal:
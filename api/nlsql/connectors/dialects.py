@@ -0,0 +1,244 @@
+import re
+from typing import List, Tuple, Union
+
+# Drivers binding parameters with %s, a literal % in the statement has to be doubled when parameters are passed
+PERCENT_PARAMSTYLE = ('mysql', 'postgresql', 'redshift', 'snowflake')
+
+_ORDER_BY = re.compile(r'\bORDER\s+BY\b', re.I)
+_LIMITED = re.compile(r'\b(LIMIT|TOP|FETCH|OFFSET)\b', re.I)
+_COMPOUND = re.compile(r'\b(UNION|INTERSECT|EXCEPT|MINUS|INTO)\b', re.I)
+_SELECT = re.compile(r'\s*SELECT(\s+(DISTINCT|ALL)\b)?', re.I)
+_WITH = re.compile(r'\s*WITH\b', re.I)
+_FROM = re.compile(r'\bFROM\b', re.I)
+_GROUP_BY = re.compile(r'\bGROUP\s+BY\b', re.I)
+_AFTER_GROUP_BY = re.compile(r'\b(HAVING|QUALIFY|WINDOW)\b', re.I)
+_GROUPING = re.compile(r'^(ROLLUP|CUBE|GROUPING\s+SETS)\b', re.I)
+_IDENTIFIER_PART = r'(?:[A-Za-z_][\w$]*|"[^"]+"|`[^`]+`|\[[^\]]+\])'
+_IDENTIFIER = re.compile(r'^{0}(?:\.{0})*$'.format(_IDENTIFIER_PART))
+_ORDER_ITEM = re.compile(r'^(?P<expr>.+?)(?:\s+(?P<direction>ASC|DESC))?(?:\s+NULLS\s+(?:FIRST|LAST))?$', re.I | re.S)
+
+
+def mask_sql(sql: str, db='') -> str:
+    """Same-length copy of sql with literals, quoted identifiers, comments and everything inside parentheses blanked
+    out, so keyword searches only see the top level of the statement"""
+    out = []
+    depth = 0
+    i = 0
+    n = len(sql)
+    while i < n:
+        c = sql[i]
+        if c in '\'"`[':
+            close = ']' if c == '[' else c
+            j = i + 1
+            while j < n:
+                if c == "'" and sql[j] == '\\' and db != 'mssql':
+                    j += 2
+                    continue
+                if sql[j] == close:
+                    if close != ']' and j + 1 < n and sql[j + 1] == close:
+                        j += 2
+                        continue
+                    break
+                j += 1
+            j = min(j, n - 1)
+            out.append(' ' * (j - i + 1))
+            i = j + 1
+        elif sql.startswith('--', i) or sql.startswith('/*', i):
+            if c == '-':
+                j = sql.find('\n', i)
+                j = n if j == -1 else j
+            else:
+                j = sql.find('*/', i + 2)
+                j = n if j == -1 else j + 2
+            out.append(' ' * (j - i))
+            i = j
+        else:
+            if c == '(':
+                depth += 1
+                out.append(c if depth == 1 else ' ')
+            elif c == ')':
+                out.append(c if depth == 1 else ' ')
+                depth = max(0, depth - 1)
+            else:
+                out.append(c if depth == 0 else ' ')
+            i += 1
+    return ''.join(out)
+
+
+def is_limited(sql: str, db='') -> bool:
+    """The statement already limits its rows at the top level (LIMIT / TOP / FETCH / OFFSET)"""
+    return bool(_LIMITED.search(mask_sql(sql, db)))
+
+
+def split_order_by(sql: str, db='') -> Tuple[str, str]:
+    """Split off the trailing top-level ORDER BY: returns (statement without it, comma separated order items)"""
+    matches = list(_ORDER_BY.finditer(mask_sql(sql, db)))
+    if not matches:
+        return sql, ''
+    last = matches[-1]
+    return sql[:last.start()].rstrip(), sql[last.end():].strip()
+
+
+def split_top_level(sql: str, db='', sep=',') -> List[str]:
+    masked = mask_sql(sql, db)
+    parts = []
+    start = 0
+    for i, c in enumerate(masked):
+        if c == sep:
+            parts.append(sql[start:i].strip())
+            start = i + 1
+    parts.append(sql[start:].strip())
+    return parts
+
+
+def shift_group_by(sql: str, db='', shift=1) -> Union[str, None]:
+    """Shift the positional items of the top-level GROUP BY by shift output columns.
+
+    Returns None when a positional item can't be told apart (ROLLUP, CUBE and GROUPING SETS).
+    """
+    masked = mask_sql(sql, db)
+    match = _GROUP_BY.search(masked)
+    if not match:
+        return sql
+    after = _AFTER_GROUP_BY.search(masked, match.end())
+    end = after.start() if after else len(sql)
+    items = []
+    for item in split_top_level(sql[match.end():end], db):
+        if item.isdigit():
+            item = str(int(item) + shift)
+        elif _GROUPING.match(item):
+            return None
+        items.append(item)
+    return f"{sql[:match.end()]} {', '.join(items)}" + (f' {sql[end:]}' if after else '')
+
+
+def placeholder(db, index: int) -> str:
+    if db == 'mssql':
+        return '?'
+    if db == 'bigquery':
+        return f'@nlsql_el_{index}'
+    return '%s'
+
+
+def batch_elements_sql(db, template: str, count: int) -> Union[str, None]:
+    """Rewrite a per-element template (one quoted '{}' placeholder) into a single UNION ALL statement.
+
+    Each branch gets a leading nlsql_batch column holding the element's position and binds the element as a
+    parameter (see placeholder) instead of formatting it into the SQL. Positional GROUP BY items are shifted past
+    that column and a trailing ORDER BY on output columns is moved behind the UNION ALL. Returns None when the
+    template can't be batched safely.
+    """
+    sql = template.strip().rstrip(';').rstrip()
+    if count < 1 or sql.count('{}') != 1 or sql.count("'{}'") != 1:
+        return None
+    if not _SELECT.match(sql):
+        return None
+    masked = mask_sql(sql, db)
+    if _LIMITED.search(masked) or _COMPOUND.search(masked):
+        return None
+
+    base, order_by = split_order_by(sql, db)
+    # the batch column shifts the output positions by one
+    base = shift_group_by(base, db)
+    if base is None:
+        return None
+    order = ['1']
+    if order_by:
+        for item in split_top_level(order_by, db):
+            match = _ORDER_ITEM.match(item)
+            if not match:
+                return None
+            expr = match.group('expr').strip()
+            if expr.isdigit():
+                expr = str(int(expr) + 1)
+            elif _IDENTIFIER.match(expr):
+                # ORDER BY of a UNION only knows the output column names
+                expr = re.findall(_IDENTIFIER_PART, expr)[-1]
+            else:
+                return None
+            order.append(f"{expr} {match.group('direction') or ''}".strip())
+
+    select = _SELECT.match(base)
+    head, tail = base[:select.end()], base[select.end():]
+    if db in PERCENT_PARAMSTYLE:
+        tail = tail.replace('%', '%%')
+    branches = [f"{head} {i} AS nlsql_batch,{tail.replace(chr(39) + '{}' + chr(39), placeholder(db, i))}"
+                for i in range(count)]
+    return '\nUNION ALL\n'.join(branches) + '\nORDER BY ' + ', '.join(order)
+
+
+def page_sql(db, sql: str, count: int, offset: int = 0) -> Union[str, None]:
+    """Limit a statement to count rows after skipping offset rows (LIMIT / OFFSET, TOP or OFFSET FETCH on mssql).
+
+    Returns None when the statement already limits its rows or the dialect can't page it (mssql needs an ORDER BY
+    to skip rows and can't TOP a compound statement).
+    """
+    sql = sql.strip().rstrip(';').rstrip()
+    if not (_SELECT.match(sql) or _WITH.match(sql)) or is_limited(sql, db):
+        return None
+    if db == 'mssql':
+        if split_order_by(sql, db)[1]:
+            return f'{sql}\nOFFSET {offset} ROWS FETCH NEXT {count} ROWS ONLY'
+        select = _SELECT.match(sql)
+        # TOP would only limit the first SELECT of a compound statement
+        if offset or not select or _COMPOUND.search(mask_sql(sql, db)):
+            return None
+        return f'{sql[:select.end()]} TOP {count}{sql[select.end():]}'
+    return f'{sql}\nLIMIT {count}' + (f' OFFSET {offset}' if offset else '')
+
+
+def keyset_column(sql: str, db='') -> Union[Tuple[str, bool], None]:
+    """(column, descending) when the statement selects the DISTINCT values of one column ordered by that column, so
+    the last value of a page is a unique key to continue after. BigQuery is left to OFFSET paging: its parameters
+    need a declared type."""
+    sql = sql.strip().rstrip(';').rstrip()
+    select = _SELECT.match(sql)
+    if db == 'bigquery' or not select or (select.group(2) or '').upper() != 'DISTINCT':
+        return None
+    masked = mask_sql(sql, db)
+    if _LIMITED.search(masked) or _COMPOUND.search(masked):
+        return None
+    from_clause = _FROM.search(masked, select.end())
+    order_by = split_order_by(sql, db)[1]
+    if not from_clause or not order_by:
+        return None
+    columns = split_top_level(sql[select.end():from_clause.start()], db)
+    items = split_top_level(order_by, db)
+    if len(columns) != 1 or len(items) != 1 or not _IDENTIFIER.match(columns[0]):
+        return None
+    match = _ORDER_ITEM.match(items[0])
+    if not match or match.group('expr').strip() not in (columns[0], '1'):
+        return None
+    return re.findall(_IDENTIFIER_PART, columns[0])[-1], (match.group('direction') or '').upper() == 'DESC'
+
+
+def keyset_page_sql(db, sql: str, count: int, column: str, descending: bool = False) -> str:
+    """Next count rows of a keyset_column statement after the value bound as the only parameter"""
+    base = split_order_by(sql.strip().rstrip(';').rstrip(), db)[0]
+    if db in PERCENT_PARAMSTYLE:
+        base = base.replace('%', '%%')
+    where = f"{column} {'<' if descending else '>'} {placeholder(db, 0)}"
+    order = column + (' DESC' if descending else '')
+    if db == 'mssql':
+        return f'SELECT TOP {count} * FROM ({base}) nlsql_page WHERE {where} ORDER BY {order}'
+    return f'SELECT * FROM ({base}) nlsql_page WHERE {where} ORDER BY {order} LIMIT {count}'
+
+
+def last_rows_sql(db, sql: str, count: int) -> Union[str, None]:
+    """The last count rows of an ordered statement, read back to front: its ORDER BY flipped, then limited.
+
+    Returns None when the statement has no top-level ORDER BY, already limits its rows or orders with an explicit
+    NULLS FIRST/LAST.
+    """
+    sql = sql.strip().rstrip(';').rstrip()
+    base, order_by = split_order_by(sql, db)
+    if not order_by or is_limited(sql, db):
+        return None
+    items = []
+    for item in split_top_level(order_by, db):
+        match = _ORDER_ITEM.match(item)
+        if not match or re.search(r'\bNULLS\b', mask_sql(item, db), re.I):
+            return None
+        flipped = 'ASC' if (match.group('direction') or '').upper() == 'DESC' else 'DESC'
+        items.append(f"{match.group('expr').strip()} {flipped}")
+    return page_sql(db, f"{base}\nORDER BY {', '.join(items)}", count)
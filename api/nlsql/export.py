@@ -0,0 +1,234 @@
+import asyncio
+import csv
+import datetime
+import decimal
+import gzip
+import os
+from typing import List, Union
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import xlsxwriter
+
+from . import artifacts
+
+REPORT_FORMATS = ('csv', 'parquet', 'xlsx')
+# Rows per worksheet in Excel, longer reports continue on the next sheet
+XLSX_MAX_ROWS = 1048576
+_XLSX_TYPES = (str, int, float, bool, decimal.Decimal, datetime.date, datetime.time, datetime.timedelta)
+
+
+def report_format(requested: str = '') -> str:
+    """Format of a report file: the one requested, else ReportFormat, else csv"""
+    fmt = (requested or os.getenv('ReportFormat', '') or 'csv').lower()
+    return fmt if fmt in REPORT_FORMATS else 'csv'
+
+
+def _gzip_enabled() -> bool:
+    return os.getenv('ReportCompression', '').lower() in ('gzip', 'gz')
+
+
+class _CsvFile:
+    def __init__(self, path: str, header: Union[List, None], compress: bool):
+        if compress:
+            self.file = gzip.open(path, 'wt', newline='', compresslevel=6)
+        else:
+            self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file, delimiter=',')
+        if header:
+            self.writer.writerow(header)
+
+    def write(self, batch: List):
+        self.writer.writerows(batch)
+
+    def close(self):
+        self.file.close()
+
+
+class _ParquetFile:
+    """One row group per batch, the schema is inferred from the first batch.
+
+    A column whose later values don't fit its type is widened (integers to float64, dates to timestamps, anything
+    else to strings) and the row groups written so far are rewritten with the wider type.
+    """
+
+    def __init__(self, path: str, header: Union[List, None], compress: bool):
+        self.path = path
+        self.header = header
+        self.schema = None
+        self.writer = None
+
+    @staticmethod
+    def _array(values, type_=None):
+        if type_ is None:
+            try:
+                array = pa.array(values)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                # mixed values in the first batch
+                return pa.array([None if el is None else str(el) for el in values], type=pa.string())
+            if array.type == pa.null():
+                # a column without values in the first batch is typed string
+                return pa.array(values, type=pa.string())
+            if pa.types.is_decimal(array.type):
+                # the precision inferred from the first batch may be too small for later values
+                return pa.array(values, type=pa.decimal128(38, array.type.scale))
+            return array
+        if (pa.types.is_integer(type_) and any(isinstance(el, float) for el in values)) or \
+                (pa.types.is_date(type_) and any(isinstance(el, datetime.datetime) for el in values)):
+            # pyarrow would truncate these silently
+            raise pa.ArrowInvalid(f'Values do not fit {type_}')
+        try:
+            return pa.array(values, type=type_)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            if pa.types.is_decimal(type_):
+                exponent = decimal.Decimal(1).scaleb(-type_.scale)
+                return pa.array([None if el is None else decimal.Decimal(el).quantize(exponent) for el in values],
+                                type=type_)
+            if pa.types.is_timestamp(type_):
+                return pa.array([datetime.datetime.combine(el, datetime.time()) if isinstance(el, datetime.date)
+                                 and not isinstance(el, datetime.datetime) else el for el in values], type=type_)
+            if type_ != pa.string():
+                raise
+            return pa.array([None if el is None else str(el) for el in values], type=type_)
+
+    @staticmethod
+    def _widen(type_, values) -> pa.DataType:
+        # a type holding both the values written as type_ and values
+        try:
+            widened = pa.array(values).type
+            if pa.types.is_integer(type_) and pa.types.is_floating(widened):
+                widened = pa.float64()
+            elif not (pa.types.is_date(type_) and pa.types.is_timestamp(widened)):
+                return pa.string()
+            pa.array(values, type=widened)
+            return widened
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            return pa.string()
+
+    def _retype(self, index: int, type_):
+        self.schema = self.schema.set(index, self.schema.field(index).with_type(type_))
+        self.writer.close()
+        part = self.path + '.part'
+        writer = pq.ParquetWriter(part, self.schema)
+        written = pq.ParquetFile(self.path)
+        for i in range(written.num_row_groups):
+            table = written.read_row_group(i)
+            if type_ == pa.string():
+                # same text as values converted in _array
+                table = table.set_column(index, self.schema.field(index),
+                                         self._array(table.column(index).to_pylist(), type_))
+            writer.write_table(table.cast(self.schema, safe=False))
+        os.replace(part, self.path)
+        self.writer = writer
+
+    def write(self, batch: List):
+        columns = list(zip(*batch))
+        if self.writer is None:
+            names = [str(el) for el in self.header] if self.header and len(self.header) == len(columns) \
+                else [f'column{i + 1}' for i in range(len(columns))]
+            table = pa.Table.from_arrays([self._array(values) for values in columns], names=names)
+            self.schema = table.schema
+            self.writer = pq.ParquetWriter(self.path, self.schema)
+        else:
+            arrays = []
+            for i, values in enumerate(columns):
+                try:
+                    arrays.append(self._array(values, self.schema.field(i).type))
+                except (pa.ArrowInvalid, pa.ArrowTypeError, decimal.InvalidOperation):
+                    self._retype(i, self._widen(self.schema.field(i).type, values))
+                    arrays.append(self._array(values, self.schema.field(i).type))
+            table = pa.Table.from_arrays(arrays, schema=self.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is None:
+            names = [str(el) for el in self.header or []]
+            self.writer = pq.ParquetWriter(self.path, pa.schema([(name, pa.string()) for name in names]))
+        self.writer.close()
+
+
+class _XlsxFile:
+    """Constant-memory workbook: every row is flushed to disk as soon as the next one starts"""
+
+    def __init__(self, path: str, header: Union[List, None], compress: bool):
+        self.workbook = xlsxwriter.Workbook(path, {'constant_memory': True,
+                                                   'default_date_format': 'yyyy-mm-dd',
+                                                   'remove_timezone': True,
+                                                   'strings_to_urls': False})
+        self.header = header
+        self.sheet = None
+        self.row = 0
+
+    def _add_sheet(self):
+        self.sheet = self.workbook.add_worksheet()
+        self.row = 0
+        if self.header:
+            self.sheet.write_row(0, 0, self.header)
+            self.row = 1
+
+    def write(self, batch: List):
+        for values in batch:
+            if self.sheet is None or self.row >= XLSX_MAX_ROWS:
+                self._add_sheet()
+            self.sheet.write_row(self.row, 0, [el if el is None or isinstance(el, _XLSX_TYPES) else str(el)
+                                               for el in values])
+            self.row += 1
+
+    def close(self):
+        if self.sheet is None:
+            self._add_sheet()
+        self.workbook.close()
+
+
+_FILES = {'csv': _CsvFile, 'parquet': _ParquetFile, 'xlsx': _XlsxFile}
+
+
+def _open(fmt: str, path: str, header: Union[List, None], compress: bool):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return _FILES[fmt](path, header, compress)
+
+
+def _discard(report, path: str):
+    try:
+        report.close()
+    except Exception:
+        pass
+    if os.path.exists(path):
+        os.remove(path)
+
+
+async def export_report(batches, file_name: str, header: Union[List, None] = None, fmt: str = 'csv') -> str:
+    """Write row batches to <file_name>.<fmt> in the static directory and return the path it is served under.
+
+    Writes run in the loop's default executor, each overlapping the fetch of the next batch, so at most two batches
+    are held in memory. The file is written as <name>.part and renamed once complete, a link handed out afterwards
+    never points at a partial file. With ReportCompression=gzip a CSV is written as <file_name>.csv.gz only; nginx
+    (gzip_static always + gunzip) serves it under the .csv name, compressed or not depending on the client.
+    """
+    loop = asyncio.get_event_loop()
+    compress = fmt == 'csv' and _gzip_enabled()
+    name = artifacts.relative(f'{file_name}.{fmt}')
+    stored_name = name + ('.gz' if compress else '')
+    path = os.path.join(artifacts.STATIC_DIR, stored_name)
+    part = path + '.part'
+    report = await loop.run_in_executor(None, _open, fmt, part, header, compress)
+    pending = None
+    try:
+        async for batch in batches:
+            if pending is not None:
+                await pending
+            pending = loop.run_in_executor(None, report.write, batch)
+        if pending is not None:
+            await pending
+        await loop.run_in_executor(None, report.close)
+        await loop.run_in_executor(None, os.replace, part, path)
+        await loop.run_in_executor(None, artifacts.record, stored_name)
+        if not compress:
+            artifacts.compress_later(stored_name)
+    except BaseException:
+        if pending is not None:
+            # never close the file under a running write
+            await asyncio.wait([pending])
+        await loop.run_in_executor(None, _discard, report, part)
+        raise
+    return name
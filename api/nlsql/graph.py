@@ -1,32 +1,68 @@
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+import gzip
+import os
 import random
+import secrets
+from typing import Union
 import numpy as np
 import datetime
 import matplotlib.ticker as ticker
 import plotly.graph_objects as go
 import plotly.io as pio
+from plotly.offline import get_plotlyjs, get_plotlyjs_version
 from itertools import groupby
 import plotly.express as px
 
+from . import artifacts, images
+from .config import get_int_env
+from .columnar import ColumnarResult
+
+_plotlyjs_url: Union[str, None] = None
+
+
+def plotlyjs_mode() -> str:
+    return 'inline' if os.getenv('PlotlyJsMode', 'shared').lower() == 'inline' else 'shared'
+
+
+def plotlyjs() -> Union[str, bool]:
+    """include_plotlyjs for write_html: the URL of the shared plotly.js file, or True to embed the library inline.
+
+    The shared file is named after the plotly.js version, written once (with a .gz for gzip_static) and served by nginx
+    with a long cache lifetime, so every chart after the first loads in kilobytes.
+    """
+    global _plotlyjs_url
+
+    if plotlyjs_mode() == 'inline':
+        return True
+    if _plotlyjs_url is None:
+        name = 'plotly-{}.min.js'.format(get_plotlyjs_version())
+        path = os.path.join(artifacts.STATIC_DIR, 'js', name)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            script = get_plotlyjs().encode()
+            for file_path, content in ((path + '.gz', gzip.compress(script, 9)), (path, script)):
+                part = '{}.{}.part'.format(file_path, secrets.token_hex(4))
+                with open(part, 'wb') as f:
+                    f.write(content)
+                os.replace(part, file_path)
+        _plotlyjs_url = '/bot/static/js/{}'.format(name)
+    return _plotlyjs_url
+
 
 def save(name='', fmt='png'):
-    import os
-
-    pwd = os.getcwd()
-    iPath = '/var/www/html/bot/static/'
-    if not os.path.exists(iPath):
-        os.mkdir(iPath)
-    os.chdir(iPath)
-    plt.savefig('{}.{}'.format(name, fmt), fmt='png')
-    os.chdir(pwd)
-    return name
+    # returns the path of the picture below the static directory, without its extension
+    relative_name = artifacts.relative('{}.{}'.format(name, fmt))
+    plt.savefig(artifacts.path(relative_name), fmt='png')
+    artifacts.record(relative_name)
+    return os.path.splitext(relative_name)[0]
 
 
 def build(array, title, Oy, Ox):
     x = []
     y = []
+    downsampled = False
 
     if Ox == 'Date':
         dates = []
@@ -42,6 +78,8 @@ def build(array, title, Oy, Ox):
                     else:
                         dates.append(i[0])
                     values.append(i[1])
+                dates, values, sampled = downsample(dates, values)
+                downsampled = downsampled or sampled
                 ax.plot(dates, values)
                 ax.scatter(dates, values, s=10, marker='o', label=u'{}'.format(key))
                 # plt.plot(x, y, label=u'{}'.format(i))
@@ -53,6 +91,7 @@ def build(array, title, Oy, Ox):
                 else:
                     dates.append(i[0])
                 values.append(i[1])
+            dates, values, downsampled = downsample(dates, values)
             # plt.plot_date(dates, values)
             ax.plot(dates, values)
             ax.scatter(dates, values, color='orange', s=30, marker='o')
@@ -81,6 +120,8 @@ def build(array, title, Oy, Ox):
                 for j in array.get(i):
                     x.append(j[0])
                     y.append(j[1])
+                x, y, sampled = downsample(x, y)
+                downsampled = downsampled or sampled
                 plt.plot(x, y, label=u'{}'.format(i))
 
             plt.legend(frameon=True)
@@ -89,6 +130,7 @@ def build(array, title, Oy, Ox):
             for i in array:
                 x.append(i[0])
                 y.append(i[1])
+            x, y, downsampled = downsample(x, y)
             plt.plot(x, y)
 
     if Ox == 'Date':
@@ -103,6 +145,8 @@ def build(array, title, Oy, Ox):
     plt.title(title)
     plt.ylabel(Oy)
     plt.xlabel(Ox)
+    if downsampled:
+        plt.figtext(0.99, 0.01, downsample_note(), horizontalalignment='right', fontsize=8, color='grey')
     code_name = ''.join([random.choice(list('123456789qwertyuiopasdfghjklzxc'
                                             'vbnmQWERTYUIOPASDFGHJKLZXCVBNM')) for x in range(8)])
     name = save(name='pic_{}'.format(code_name), fmt='png')
@@ -137,12 +181,93 @@ def build_bar(array, title):
     return name
 
 
-def build_html_chart(array, title, Oy, Ox, mode='lines+markers', bubbles=False):
+def write_chart(fig, file_name=None):
+    """Write pio_<file_name>.html and .jpg into the static directory and return their paths below it.
+
+    Both files are written under a temporary name and renamed when complete, so a chart whose files exist is never
+    served half-written, even while another process renders the same one.
+    """
+    if file_name is None:
+        file_name = ''.join([random.choice(list('123456789qwertyuiopasdfghjklzxc'
+                                                'vbnmQWERTYUIOPASDFGHJKLZXCVBNM')) for x in range(10)])
+    name_html = artifacts.relative('pio_{}.html'.format(file_name))
+    name_jpg = artifacts.relative('pio_{}.jpg'.format(file_name))
+    file_path = artifacts.path(name_html)
+    part = '{}.{}.part'.format(file_path, secrets.token_hex(4))
+    try:
+        pio.write_html(fig, file=part, auto_open=False, include_plotlyjs=plotlyjs())
+        images.write_image(fig, artifacts.path(name_jpg))
+        os.replace(part, file_path)
+    finally:
+        if os.path.exists(part):
+            os.remove(part)
+    artifacts.record(name_html)
+    artifacts.record(name_jpg)
+    return name_html, name_jpg
+
+
+def _lttb(x, y, threshold: int) -> np.ndarray:
+    """Indices of the threshold points Largest-Triangle-Three-Buckets keeps of the series (x, y).
+
+    The first and last points are kept, the others are split into threshold - 2 buckets and each bucket keeps the
+    point forming the largest triangle with the point kept before it and the mean of the next bucket. x values that
+    are not numbers (dates, labels) are placed by their position.
+    """
+    n = len(y)
+    ys = np.asarray(y, dtype=float)
+    try:
+        xs = np.asarray(x, dtype=float)
+    except (TypeError, ValueError):
+        xs = np.arange(n, dtype=float)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    # means of every bucket, the point after the last bucket stands for the one following it
+    starts, ends = edges[:-1], edges[1:]
+    counts = ends - starts
+    mean_x = np.append(np.add.reduceat(xs[:n - 1], starts) / counts, xs[n - 1])
+    mean_y = np.append(np.add.reduceat(ys[:n - 1], starts) / counts, ys[n - 1])
+    keep = np.empty(threshold, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        area = np.abs((xs[a] - mean_x[i + 1]) * (ys[start:end] - ys[a])
+                      - (xs[a] - xs[start:end]) * (mean_y[i + 1] - ys[a]))
+        a = start + int(np.argmax(np.nan_to_num(area, nan=-1.0)))
+        keep[i + 1] = a
+    return keep
+
+
+def downsample(x, y):
+    """(x, y, downsampled): the series reduced to ChartMaxPoints points with LTTB when it is longer"""
+    max_points = get_int_env('ChartMaxPoints', 2000)
+    if max_points < 3 or len(y) <= max_points:
+        return x, y, False
+    try:
+        keep = _lttb(x, y, max_points)
+    except (TypeError, ValueError):
+        # y values that are not numbers
+        return x, y, False
+    return [x[i] for i in keep], [y[i] for i in keep], True
+
+
+def downsample_note() -> str:
+    return 'Downsampled to {} points per series'.format(get_int_env('ChartMaxPoints', 2000))
+
+
+def _xy(array):
+    # x and y values of a row result, read straight from the columns of a ColumnarResult
+    if isinstance(array, ColumnarResult):
+        return array.column(0), array.column(1)
+    return [i[0] for i in array], [i[1] for i in array]
+
+
+def build_html_chart(array, title, Oy, Ox, mode='lines+markers', bubbles=False, file_name=None):
     """
     :param mode: available 'lines+markers' or 'markers'
+    :param file_name: name of the chart files without prefix and extension, random when not given
     """
     x = []
     y = []
+    downsampled = False
     fig = go.Figure()
     if Ox == 'Months':
         month = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
@@ -222,6 +347,8 @@ def build_html_chart(array, title, Oy, Ox, mode='lines+markers', bubbles=False):
                     else:
                         dates.append(i[0])
                     values.append(int(i[1]))
+                dates, values, sampled = downsample(dates, values)
+                downsampled = downsampled or sampled
                 x = np.array(dates)
                 y = np.array(values)
                 if bubbles:
@@ -238,6 +365,7 @@ def build_html_chart(array, title, Oy, Ox, mode='lines+markers', bubbles=False):
                 else:
                     dates.append(i[0])
                 values.append(int(i[1]))
+            dates, values, downsampled = downsample(dates, values)
             # plt.plot_date(dates, values)
             x = np.array(dates)
             y = np.array(values)
@@ -252,11 +380,8 @@ def build_html_chart(array, title, Oy, Ox, mode='lines+markers', bubbles=False):
         # for multi-graph {key: list}
         if type(array) == dict:
             for i in array:
-                x = []
-                y = []
-                for j in array.get(i):
-                    x.append(j[0])
-                    y.append(j[1])
+                x, y, sampled = downsample(*_xy(array.get(i)))
+                downsampled = downsampled or sampled
                 x = np.array(x)
                 y = np.array(y)
                 if bubbles:
@@ -268,9 +393,7 @@ def build_html_chart(array, title, Oy, Ox, mode='lines+markers', bubbles=False):
                     fig.add_trace(go.Scatter(x=x, y=y, mode=mode, name=i))
 
         else:
-            for i in array:
-                x.append(i[0])
-                y.append(i[1])
+            x, y, downsampled = downsample(*_xy(array))
             x = np.array(x)
             y = np.array(y)
             if bubbles:
@@ -284,18 +407,13 @@ def build_html_chart(array, title, Oy, Ox, mode='lines+markers', bubbles=False):
     fig.update_layout(title=title,
                       xaxis_title=Ox,
                       yaxis_title=Oy)
-    file_name = ''.join([random.choice(list('123456789qwertyuiopasdfghjklzxc'
-                                            'vbnmQWERTYUIOPASDFGHJKLZXCVBNM')) for x in range(10)])
-    name_html = 'pio_{}.html'.format(file_name)
-    name_jpg = 'pio_{}.jpg'.format(file_name)
-    file_path = '/var/www/html/bot/static/{}'.format(name_html)
-    file_path_jpg = '/var/www/html/bot/static/{}'.format(name_jpg)
-    pio.write_html(fig, file=file_path, auto_open=False)
-    fig.write_image(file_path_jpg, engine="kaleido")
-    return name_html, name_jpg
+    if downsampled:
+        fig.add_annotation(text=downsample_note(), xref='paper', yref='paper', x=1, y=1, xanchor='right',
+                           yanchor='bottom', showarrow=False, font=dict(size=10, color='grey'))
+    return write_chart(fig, file_name)
 
 
-def build_html_pie(array, title):
+def build_html_pie(array, title, file_name=None):
     x = []
     y = []
     # Can't build pie with negative values. If all values negative change it to absolute.
@@ -321,18 +439,10 @@ def build_html_pie(array, title):
         fig = go.Figure(data=data)
         fig.update_layout(title=title)
         fig.update_traces(textposition='inside', textinfo='label+percent', textfont_size=20,)
-        file_name = ''.join([random.choice(list('123456789qwertyuiopasdfghjklzxc'
-                                                'vbnmQWERTYUIOPASDFGHJKLZXCVBNM')) for x in range(10)])
-        name_html = 'pio_{}.html'.format(file_name)
-        name_jpg = 'pio_{}.jpg'.format(file_name)
-        file_path = '/var/www/html/bot/static/{}'.format(name_html)
-        file_path_jpg = '/var/www/html/bot/static/{}'.format(name_jpg)
-        pio.write_html(fig, file=file_path, auto_open=False)
-        fig.write_image(file_path_jpg, engine="kaleido")
-        return name_html, name_jpg
+        return write_chart(fig, file_name)
 
 
-def build_html_bar(array, title, Ox, Oy, barmode=False):
+def build_html_bar(array, title, Ox, Oy, barmode=False, file_name=None):
     """
 
     :param array:
@@ -340,6 +450,7 @@ def build_html_bar(array, title, Ox, Oy, barmode=False):
     :param Ox:
     :param Oy:
     :param barmode: False. available: relative(stacked), group, overlay, False
+    :param file_name: name of the chart files without prefix and extension, random when not given
     :return:
     """
     def parse_array(inner_array):
@@ -385,19 +496,10 @@ def build_html_bar(array, title, Ox, Oy, barmode=False):
     fig.update_layout(title=title,
                       xaxis_title=Ox,
                       yaxis_title=Oy)
-    file_name = ''.join([random.choice(list('123456789qwertyuiopasdfghjklzxc'
-                                            'vbnmQWERTYUIOPASDFGHJKLZXCVBNM')) for x in range(10)])
-    name_html = 'pio_{}.html'.format(file_name)
-    name_jpg = 'pio_{}.jpg'.format(file_name)
-    file_path = '/var/www/html/bot/static/{}'.format(name_html)
-    file_path_jpg = '/var/www/html/bot/static/{}'.format(name_jpg)
-    pio.write_html(fig, file=file_path, auto_open=False)
-    fig.write_image(file_path_jpg, engine="kaleido")
-
-    return name_html, name_jpg
+    return write_chart(fig, file_name)
 
 
-def build_html_map(df, title, colorbar_title, locationmode='country names'):
+def build_html_map(df, title, colorbar_title, locationmode='country names', file_name=None):
     fig = go.Figure(data=go.Choropleth(
         locations=df['country'],
         locationmode=locationmode,
@@ -421,13 +523,4 @@ def build_html_map(df, title, colorbar_title, locationmode='country names'):
         ),
     )
 
-    file_name = ''.join([random.choice(list('123456789qwertyuiopasdfghjklzxc'
-                                            'vbnmQWERTYUIOPASDFGHJKLZXCVBNM')) for x in range(10)])
-    name_html = 'pio_{}.html'.format(file_name)
-    name_jpg = 'pio_{}.jpg'.format(file_name)
-    file_path = '/var/www/html/bot/static/{}'.format(name_html)
-    file_path_jpg = '/var/www/html/bot/static/{}'.format(name_jpg)
-    pio.write_html(fig, file=file_path, auto_open=False)
-    fig.write_image(file_path_jpg, engine="kaleido")
-
-    return name_html, name_jpg
+    return write_chart(fig, file_name)
@@ -1,21 +1,44 @@
-import csv
+import asyncio
 import datetime
+import json
 import os
 import random
+import re
+import secrets
+import time
 from typing import List, Union, Dict
 from json.decoder import JSONDecodeError
-import requests
 from botbuilder.schema import ActionTypes
-from .connectors import connectors
+from .connectors import connectors, dialects
 import logging
 
-from . import graph
+from . import artifacts, charts, export, graph, http_client, metrics, render, session
+from .cache import TTLCache
+from .config import get_int_env, get_number_env
 from .nlsql_typing import Buttons, NLSQLAnswer
 
 logging.basicConfig(level=logging.INFO)
 
-
-
+# NLSQL API translations keyed on the canonical message text. Disabled unless ApiCacheSize > 0
+translation_cache = TTLCache(maxsize=get_int_env('ApiCacheSize', 0), ttl=get_number_env('ApiCacheTTL', 3600))
+metrics.register_cache('translation', translation_cache)
+# Button postbacks ([{[key:value]}], [[[key:value]]], [%[key:value]%]) and quoted literals carry values
+# that are matched verbatim, so their case and inner whitespace are kept in the cache key
+_VERBATIM_TEXT = re.compile(r"[\[\]'\"`]")
+# Elements per page of a graph/scatter/bubble-complex chart
+PAGE_SIZE = 10
+# "Show next N elements" buttons carry a continuation token: [#page:token#]
+_CONTINUATION = re.compile(r'\s*\[#page:([\w-]+)#\]\s*$')
+# Continuation tokens kept per conversation, the oldest are dropped first
+MAX_CONTINUATIONS = 20
+# Rows an answer type can show. Its SQL is limited to one row more, so truncation is still detected
+MAX_ROWS = {'message': 50, 'bar': 20}
+# Reports shorter than this are answered with an adaptive card, longer ones with a file
+CARD_MAX_ROWS = 10
+
+
+
+@metrics.timed('card')
 async def create_addition_buttons(answer, count='20') -> Union[List[Buttons], None]:
     logging.info(f"Answer: {answer}\n\n")
     logging.info(f"Count: {count}\n\n")
@@ -30,6 +53,7 @@ async def create_addition_buttons(answer, count='20') -> Union[List[Buttons], No
     return None
 
 
+@metrics.timed('card')
 async def create_adaptive_card_attachment(data: list, text, column_names) -> Dict:
     text_block = {
                 "type": "TextBlock",
@@ -94,6 +118,7 @@ async def create_adaptive_card_attachment(data: list, text, column_names) -> Dic
     return card_data
 
 
+@metrics.timed('card')
 async def create_arg_buttons(result, channel, data_type='arg_buttons'):
     buttons = []
     button_all_options = None
@@ -122,6 +147,7 @@ async def create_arg_buttons(result, channel, data_type='arg_buttons'):
     return None
 
 
+@metrics.timed('card')
 async def create_system_buttons(result, channel):
     buttons = []
     word_dict = result[1]
@@ -165,6 +191,7 @@ async def generate_like_button(result, key: str, word: str, buttons: List, postb
     buttons.append(button)
 
 
+@metrics.timed('card')
 async def create_complex_buttons(result: List[Union[str, Dict]], channel):
     buttons = []
     word_dict = result[-1]
@@ -197,19 +224,24 @@ async def create_complex_buttons(result: List[Union[str, Dict]], channel):
         return buttons
     return None
 
-# List of elements global variable to store additional elements for addition button presses
-list_of_elements = []
-previous_add_btn = ''
 # main function to parse request
-async def parsing_text(channel_id: str, text: str) -> NLSQLAnswer:
-    global list_of_elements
-    global previous_add_btn
-
+@metrics.timed('total')
+async def parsing_text(channel_id: str, text: str, conversation_id: str = '', report_format: str = '') -> NLSQLAnswer:
     if channel_id == 'msteams':
         text = text.replace('\u200b', '')
+    # A valid continuation token answers with the stored translation of the previous page, an unknown or expired
+    # one falls back to translating the button text
+    continuation = None
+    token = _CONTINUATION.search(text)
+    if token:
+        text = text[:token.start()]
+        state = await session.load(channel_id, conversation_id)
+        continuation = state.get('pages', {}).get(token.group(1))
+    api_start = time.perf_counter()
     try:
-        api_response = await api_post(text)
+        api_response = continuation['api_response'] if continuation else await api_post(text)
     except JSONDecodeError:
+        metrics.observe('api', time.perf_counter() - api_start)
         answer = "Google API usage limit reached. The bot encountered an error. " \
                  "Please, try again later or contact the support."
         return {'answer': answer,
@@ -222,7 +254,6 @@ async def parsing_text(channel_id: str, text: str) -> NLSQLAnswer:
                 }
     logging.info(f"Channel ID: {channel_id}")
     logging.info(f"API Response: {api_response}\n\n")
-    logging.info(f"List of Elements: {list_of_elements}\n\n")
     logging.info(f"Text: {text}\n\n")
     data_type = api_response.get('data_type', '')
     sql = api_response.get('sql', '')
@@ -240,12 +271,14 @@ async def parsing_text(channel_id: str, text: str) -> NLSQLAnswer:
     if not addition_buttons:
         addition_buttons = None
     logging.info(f"Addition Buttons: {addition_buttons}")
-    logging.info(f"Previous addition buttons: {previous_add_btn}")
     # Check db connection params
     db_type = os.getenv('DatabaseType', 'mysql')
     if db_type:
         # make case-insensitive db-type input
         db_type = db_type.lower()
+    metrics.set_labels(data_type, db_type)
+    metrics.observe('api', time.perf_counter() - api_start)
+    metrics.REQUESTS.labels(data_type, db_type).inc()
     snowflake_db_attr = ('Account', 'Warehouse', 'DbName', 'DbSchema', 'DbUser', 'DbPassword')
     bigquery_db_attr = ('client_email', 'token_uri', 'private_key', 'project_id')
     other_db_attr = ('DataSource', 'DbName', 'DbPassword', 'DbUser')
@@ -266,9 +299,10 @@ async def parsing_text(channel_id: str, text: str) -> NLSQLAnswer:
                 'card_data': None,
                 'buttons': None
                 }
+    conn = None
     try:
         db_param = await connectors.get_db_param(db_type)
-        conn = await connectors.get_connector(db_type, **db_param)
+        conn = await connectors.acquire_connection(db_type, **db_param)
 
     except Exception as e:
         answer = "Can't connect to DataBase: {}. " \
@@ -286,12 +320,11 @@ async def parsing_text(channel_id: str, text: str) -> NLSQLAnswer:
             result_el_1 = ''
             result_el_2 = ''
             if sql:
-                result = await connectors.do_query_formatting(db_type, conn, sql)
-                # Close db connection
-                if db_type in ['mssql', 'postgresql']:
-                    await conn.close()
-                else:
-                    conn.close()
+                result = await connectors.do_query_formatting(db_type, conn,
+                                                              limit_rows(db_type, sql, MAX_ROWS['message'] + 1))
+                # Return db connection to the pool
+                await connectors.release_connection(db_type, conn)
+                conn = None
             else:
                 # hint message
                 return {'answer': message,
@@ -324,17 +357,17 @@ async def parsing_text(channel_id: str, text: str) -> NLSQLAnswer:
                 if type(result[0]) == datetime.date:
                     result = str(result[0])
                 elif '{result_el_1}' in message and '{result_el_2}' in message:
-                    if len(result) > 50:
-                        result = result[:50]
-                        message = "First 50 " + message
+                    if len(result) > MAX_ROWS['message']:
+                        result = result[:MAX_ROWS['message']]
+                        message = f"First {MAX_ROWS['message']} " + message
                     result_el_1 = [str(i[0]) for i in result]
                     result_el_2 = [str(round(i[1], 2)) for i in result]
                     result_el_1 = ", ".join(result_el_1)
                     result_el_2 = ", ".join(result_el_2)
                 elif len(result) > 1:
-                    if len(result) > 50:
-                        result = result[:50]
-                        message = "First 50 " + message
+                    if len(result) > MAX_ROWS['message']:
+                        result = result[:MAX_ROWS['message']]
+                        message = f"First {MAX_ROWS['message']} " + message
                     if '*{result_el}*' not in message:
                         # '*{result_el}*' means that each answer comes with a corresponding argument
                         result = ", ".join(str(i[0]) if type(i) == list or type(i) == tuple else str(i) for i in result)
@@ -374,55 +407,96 @@ async def parsing_text(channel_id: str, text: str) -> NLSQLAnswer:
             stacked_bar_mod = True if data_type in ["bar-stacked", "bar-grouped"] else False
 
             if data_type in ["graph-complex", "scatter-complex", "bubble-complex"]:
-                # Check message is for next graph or empty the elements list.
-                if text.replace(" ", "") != previous_add_btn.replace(" ", "") and list_of_elements:
-                    list_of_elements = []
-                # Populate list of elements if it doesn't already contain elements
-                if not list_of_elements:
-                    list_of_elements = await connectors.do_query(db_type, conn, sql.get('sql-get-elements'))
-                if not list_of_elements or (type(list_of_elements) != dict and None in list_of_elements[0]):
+                state = await session.load(channel_id, conversation_id)
+                elements_sql = sql.get('sql-get-elements')
+                # Only the elements of this page are fetched, a continued page picks up after the last element of
+                # the previous one when the element query allows it
+                after = continuation.get('after') if continuation else None
+                try:
+                    elements_page = await get_elements_page(db_type, conn, elements_sql, graph_range, after)
+                except Exception as e:
+                    logging.warning(f"Paged element query failed, querying all elements: {e}")
+                    await connectors.release_connection(db_type, conn, discard=True)
+                    conn = None
+                    conn = await connectors.acquire_connection(db_type, **db_param)
+                    elements_page = None
+                if elements_page is not None:
+                    filtered_elements, more_elements, after = elements_page
+                else:
+                    # The element list is reused only when the message is the addition button of the answer that
+                    # stored it, anything else queries the elements again
+                    list_of_elements = state.get('elements')
+                    if not (list_of_elements and state.get('elements_sql') == elements_sql
+                            and text.replace(" ", "") == state.get('add_btn', '').replace(" ", "")):
+                        list_of_elements = await connectors.do_query(db_type, conn, elements_sql)
+                        state = {'elements': list_of_elements, 'elements_sql': elements_sql,
+                                 'pages': state.get('pages', {})}
+                    logging.info(f"List of Elements: {len(list_of_elements)}\n\n")
+                    # Get first 10 elements from list
+                    filtered_elements = list_of_elements[graph_range-10:graph_range]
+                    more_elements = len(list_of_elements) > graph_range
+                    after = None
+                logging.info(f"Filtered List: {filtered_elements}\n\n")
+                if not filtered_elements or None in filtered_elements[0]:
                     result = []
                 else:
                     result = {}
                     sql = sql.get('sql-final')
-                    if db_type == "mssql":
-                        escape_rule = "'"
-                    else:
-                        escape_rule = "\\"
-                    _special_chars_map = {i: escape_rule + chr(i) for i in b"'"}
-                    if data_type in ["graph-complex", "scatter-complex", "bubble-complex"]:
-                        # Get first 10 elements from list
-                        filtered_elements = list_of_elements[graph_range-10:graph_range]
-                        # filtered_elements = list_of_elements[:graph_range]
-                        # # Remove first 10 elements from list
-                        # list_of_elements = list_of_elements[graph_range:]
-                        # logging.info(f"Elements List: {list_of_elements}\n\n")
-                        logging.info(f"Filtered List: {filtered_elements}\n\n")
-                    else:
-                        filtered_elements = list_of_elements
-                        list_of_elements = []
-                    for el in filtered_elements:
-                        escaping_el = str(el[0]).translate(_special_chars_map)
-                        result_element = await connectors.do_query(db_type, conn, sql.format(escaping_el),
-                                                                   map_mode=map_mode)
+                    result_elements = await do_batched_query(db_type, conn, sql,
+                                                             [el[0] for el in filtered_elements])
+                    if result_elements is None:
+                        # do_batched_query has handed the connection back, the fan-out checks out its own
+                        conn = None
+                        if db_type == "mssql":
+                            escape_rule = "'"
+                        else:
+                            escape_rule = "\\"
+                        _special_chars_map = {i: escape_rule + chr(i) for i in b"'"}
+                        queries = {}
+                        for el in filtered_elements:
+                            escaping_el = str(el[0]).translate(_special_chars_map)
+                            queries[el[0]] = sql.format(escaping_el)
+                        result_elements = await do_queries(db_type, db_param, queries, map_mode)
+                    for key in result_elements:
+                        result_element = result_elements.get(key)
                         if result_element and None not in result_element[0]:
-                            result.update(dict({el[0]: result_element}))
+                            result.update(dict({key: result_element}))
             else:
                 if type(sql) == dict:
                     result = {}
-                    for i in sql:
-                        result_element = await connectors.do_query(db_type, conn, sql.get(i), map_mode=map_mode)
+                    # The fan-out checks out its own pooled connections
+                    await connectors.release_connection(db_type, conn)
+                    conn = None
+                    queries = dict(sql)
+                    flipped = set()
+                    if data_type == 'bar':
+                        for key, value in sql.items():
+                            last_rows = last_rows_sql(db_type, value, MAX_ROWS['bar'] + 1)
+                            if last_rows:
+                                queries[key] = last_rows
+                                flipped.add(key)
+                    result_elements = await do_queries(db_type, db_param, queries, map_mode)
+                    for key in flipped:
+                        # read back to front, restore the statement's order
+                        result_elements.get(key, []).reverse()
+                    for i in result_elements:
+                        result_element = result_elements.get(i)
                         if result_element and None not in result_element[0]:
                             result.update(dict({i: result_element}))
                 else:
-                    result = await connectors.do_query(db_type, conn, sql,
-                                                       map_mode=map_mode, stacked_bar_mod=stacked_bar_mod)
-
-            # Close db connection
-            if db_type in ['mssql', 'postgresql']:
-                await conn.close()
-            else:
-                conn.close()
+                    # A bar chart shows the last rows only (see graph.build_html_bar)
+                    last_rows = last_rows_sql(db_type, sql, MAX_ROWS['bar'] + 1) if data_type == 'bar' else None
+                    result = await connectors.do_query(db_type, conn, last_rows or sql,
+                                                       map_mode=map_mode, stacked_bar_mod=stacked_bar_mod,
+                                                       columnar=True)
+                    if last_rows:
+                        # read back to front, restore the statement's order
+                        result.reverse()
+
+            # Return db connection to the pool before building the chart
+            if conn is not None:
+                await connectors.release_connection(db_type, conn)
+                conn = None
             if not result or (type(result) != dict and None in result[0]):
                 answer = message.get('fail', '')
                 return {'answer': answer,
@@ -443,8 +517,13 @@ async def parsing_text(channel_id: str, text: str) -> NLSQLAnswer:
                     #         n = len(list_of_elements)
                     #         previous_add_btn = addition_buttons
                     #     addition_buttons = await create_addition_buttons(addition_buttons, n)
-                    if data_type in ["graph-complex", "scatter-complex", "bubble-complex"] and len(list_of_elements) > graph_range:
+                    if data_type in ["graph-complex", "scatter-complex", "bubble-complex"] and more_elements:
                         logging.info(f"Data-Type: {data_type}, Graph Range: {graph_range}\n\n")
+                        if isinstance(addition_buttons, str):
+                            state['add_btn'] = addition_buttons
+                            token = await save_continuation(channel_id, conversation_id, state, api_response,
+                                                            graph_range + PAGE_SIZE, after)
+                            addition_buttons = f'{addition_buttons} [#page:{token}#]'
                         addition_buttons = await create_addition_buttons(addition_buttons, '10')
                     elif (len(result) >= 20 and db_type not in ["bar-stacked", "bar-grouped"]) \
                             or (db_type in ["bar-stacked", "bar-grouped"]
@@ -455,62 +534,55 @@ async def parsing_text(channel_id: str, text: str) -> NLSQLAnswer:
                 else:
                     addition_buttons = None
 
-                if data_type in ["graph", "map", "graph-complex", "scatter-complex", "scatter", "bubble-complex",
-                                 "bubble"]:
-                    if data_type == "map":
-                        name_html, name_jpg = graph.build_html_map(result, message.get('title', ''),
-                                                                   colorbar_title=message.get('Oy', ''),
-                                                                   locationmode=message.get('format', 'country names'))
-                    elif data_type in ["scatter-complex", "scatter"]:
-                        name_html, name_jpg = graph.build_html_chart(result, message.get('title', ''),
-                                                                     Oy=message.get('Oy', ''),
-                                                                     Ox=message.get('Ox', ''), mode="markers")
-                    elif data_type in ["bubble-complex", "bubble"]:
-                        name_html, name_jpg = graph.build_html_chart(result, message.get('title', ''),
-                                                                     Oy=message.get('Oy', ''),
-                                                                     Ox=message.get('Ox', ''), mode="markers",
-                                                                     bubbles=True)
-                    else:
-                        name_html, name_jpg = graph.build_html_chart(result, message.get('title', ''),
-                                                                     Oy=message.get('Oy', ''), Ox='Date')
-                    url = '{}/bot/static/{}'.format(os.getenv('StaticEndPoint'), name_html)
-                    img_url = '{}/bot/static/{}'.format(os.getenv('StaticEndPoint'), name_jpg)
-                    return {'answer': 'Your chart',
-                            'answer_type': 'hero_card',
-                            'buttons': [{'type': ActionTypes.open_url, 'title': 'Open Chart', 'value': url}],
-                            'images': [{'img_url': img_url}],
-                            'addition_buttons': addition_buttons,
-                            'card_data': None,
-                            'unaccounted': unaccounted
-                            }
-                elif data_type == 'pie':
-                    name_html, name_jpg = graph.build_html_pie(result, message.get('title', ''))
-                    url = '{}/bot/static/{}'.format(os.getenv('StaticEndPoint'), name_html)
-                    img_url = '{}/bot/static/{}'.format(os.getenv('StaticEndPoint'), name_jpg)
-                    return {'answer': 'Your chart',
-                            'answer_type': 'hero_card',
-                            'buttons': [{'type': ActionTypes.open_url, 'title': 'Open Chart', 'value': url}],
-                            'images': [{'img_url': img_url}],
-                            'addition_buttons': addition_buttons,
-                            'card_data': None,
-                            'unaccounted': unaccounted
-                            }
-                else:
-                    # data_type is 'bar' or 'bar-stacked' or "bar-grouped"
-                    barmode = {"bar-stacked": "relative", "bar-grouped": "group"}
-                    name_html, name_jpg = graph.build_html_bar(result, message.get('title', ''),
-                                                               Oy=message.get('Oy', ''), Ox=message.get('Ox', ''),
-                                                               barmode=barmode.get(data_type, False))
-                    url = '{}/bot/static/{}'.format(os.getenv('StaticEndPoint'), name_html)
-                    img_url = '{}/bot/static/{}'.format(os.getenv('StaticEndPoint'), name_jpg)
-                    return {'answer': 'Your chart',
-                            'answer_type': 'hero_card',
-                            'buttons': [{'type': ActionTypes.open_url, 'title': 'Open Chart', 'value': url}],
-                            'images': [{'img_url': img_url}],
-                            'addition_buttons': addition_buttons,
+                barmode = {"bar-stacked": "relative", "bar-grouped": "group"}
+                try:
+                    with metrics.timer('render'):
+                        if data_type == "map":
+                            name_html, name_jpg = await charts.build(
+                                graph.build_html_map, result, message.get('title', ''),
+                                colorbar_title=message.get('Oy', ''),
+                                locationmode=message.get('format', 'country names'))
+                        elif data_type in ["scatter-complex", "scatter"]:
+                            name_html, name_jpg = await charts.build(
+                                graph.build_html_chart, result, message.get('title', ''),
+                                Oy=message.get('Oy', ''), Ox=message.get('Ox', ''), mode="markers")
+                        elif data_type in ["bubble-complex", "bubble"]:
+                            name_html, name_jpg = await charts.build(
+                                graph.build_html_chart, result, message.get('title', ''),
+                                Oy=message.get('Oy', ''), Ox=message.get('Ox', ''), mode="markers", bubbles=True)
+                        elif data_type in ["graph", "graph-complex"]:
+                            name_html, name_jpg = await charts.build(
+                                graph.build_html_chart, result, message.get('title', ''),
+                                Oy=message.get('Oy', ''), Ox='Date')
+                        elif data_type == 'pie':
+                            name_html, name_jpg = await charts.build(graph.build_html_pie, result,
+                                                                     message.get('title', ''))
+                        else:
+                            # data_type is 'bar' or 'bar-stacked' or "bar-grouped"
+                            name_html, name_jpg = await charts.build(
+                                graph.build_html_bar, result, message.get('title', ''),
+                                Oy=message.get('Oy', ''), Ox=message.get('Ox', ''),
+                                barmode=barmode.get(data_type, False))
+                except render.RenderUnavailable as e:
+                    logging.warning(f"Chart not rendered: {e}")
+                    return {'answer': "The chart service is busy. Please, try again later.",
+                            'answer_type': 'text',
+                            'addition_buttons': None,
+                            'unaccounted': unaccounted,
+                            'images': None,
                             'card_data': None,
-                            'unaccounted': unaccounted
+                            'buttons': None
                             }
+                url = artifacts.url(name_html)
+                img_url = artifacts.url(name_jpg)
+                return {'answer': 'Your chart',
+                        'answer_type': 'hero_card',
+                        'buttons': [{'type': ActionTypes.open_url, 'title': 'Open Chart', 'value': url}],
+                        'images': [{'img_url': img_url}],
+                        'addition_buttons': addition_buttons,
+                        'card_data': None,
+                        'unaccounted': unaccounted
+                        }
 
         elif data_type == 'buttons':
             if system_buttons:
@@ -546,63 +618,83 @@ async def parsing_text(channel_id: str, text: str) -> NLSQLAnswer:
                     'unaccounted': unaccounted
                     }
         elif data_type == 'report':
-            result = await connectors.do_query_formatting(db_type, conn, sql)
-            # Close db connection
-            if db_type in ['mssql', 'postgresql']:
-                await conn.close()
+            # Rows are streamed batch by batch, a result shorter than a batch is complete after the first one.
+            # CSV files keep the formatted values, Parquet and XLSX get the raw ones
+            report_format = export.report_format(report_format)
+            batch_size = max(get_int_env('QueryBatchSize', 5000), CARD_MAX_ROWS)
+            if report_format == 'csv':
+                batches = connectors.iter_query_formatting(db_type, conn, sql, batch_size)
             else:
-                conn.close()
-            if result:
-                if message:
-                    msg_success = message.get('success', '')
-                else:
-                    msg_success = ''
-                # Send table in message for not bulk result, else send csv
-                if len(result) < 10 and len(result[0]) <= 5:
-                    indicator = indicator.get('columns', '')
-                    card_data = await create_adaptive_card_attachment(result, msg_success, indicator)
-
-                    return {'answer_type': 'adaptive_card',
-                            'answer': msg_success,
-                            'card_data': card_data,
-                            'unaccounted': unaccounted,
-                            'images': None,
-                            'addition_buttons': None,
-                            'buttons': None
-                            }
-                else:
-                    # if not indicator.get('columns', ''), than get columns name - select pg_get_cols('tablename');
-                    # get table name from indicator.get('table', '')
-                    msg_success = msg_success if msg_success else 'Your file'
-                    if not indicator.get('columns', ''):
-                        indicator = ''
+                batches = connectors.iter_query(db_type, conn, sql, batch_size)
+            try:
+                try:
+                    result = await batches.__anext__()
+                except StopAsyncIteration:
+                    result = []
+                if result:
+                    if message:
+                        msg_success = message.get('success', '')
                     else:
+                        msg_success = ''
+                    # Send table in message for not bulk result, else send csv
+                    if len(result) < CARD_MAX_ROWS and len(result[0]) <= 5:
                         indicator = indicator.get('columns', '')
-                    file_name = 'file_' + ''.join([random.choice(list('123456789qwertyuiopasdfghjklzxc'
-                                                                      'vbnmQWERTYUIOPASDFGHJKLZXCVBNM')) for x in
-                                                   range(8)])
-                    iPath = '/var/www/html/bot/static/{}.csv'.format(file_name)
-
-                    await write_csv(result, iPath, 'a', indicator)
-                    url = '{}/bot/static/{}.csv'.format(os.getenv('StaticEndPoint'), file_name)
-                    return {'answer': msg_success,
-                            'answer_type': 'hero_card',
-                            'buttons': [{'type': ActionTypes.open_url, 'title': 'Open', 'value': url}],
+                        if report_format != 'csv':
+                            result = await connectors.format_rows(result)
+                        card_data = await create_adaptive_card_attachment(result, msg_success, indicator)
+
+                        return {'answer_type': 'adaptive_card',
+                                'answer': msg_success,
+                                'card_data': card_data,
+                                'unaccounted': unaccounted,
+                                'images': None,
+                                'addition_buttons': None,
+                                'buttons': None
+                                }
+                    else:
+                        # if not indicator.get('columns', ''), than get columns name - select pg_get_cols('tablename');
+                        # get table name from indicator.get('table', '')
+                        msg_success = msg_success if msg_success else 'Your file'
+                        if not indicator.get('columns', ''):
+                            indicator = ''
+                        else:
+                            indicator = indicator.get('columns', '')
+                        file_name = 'file_' + ''.join([random.choice(list('123456789qwertyuiopasdfghjklzxc'
+                                                                          'vbnmQWERTYUIOPASDFGHJKLZXCVBNM')) for x in
+                                                       range(8)])
+
+                        with metrics.timer('file_write'):
+                            name = await export.export_report(chain_batches(result, batches), file_name, indicator,
+                                                              report_format)
+                        url = artifacts.url(name)
+                        return {'answer': msg_success,
+                                'answer_type': 'hero_card',
+                                'buttons': [{'type': ActionTypes.open_url, 'title': 'Open', 'value': url}],
+                                'addition_buttons': None,
+                                'images': None,
+                                'card_data': None,
+                                'unaccounted': unaccounted
+                                }
+                else:
+                    answer = message.get('fail', 'Can\'t get any answer')
+                    return {'answer': answer,
+                            'answer_type': 'text',
                             'addition_buttons': None,
+                            'unaccounted': unaccounted,
                             'images': None,
                             'card_data': None,
-                            'unaccounted': unaccounted
+                            'buttons': None
                             }
-            else:
-                answer = message.get('fail', 'Can\'t get any answer')
-                return {'answer': answer,
-                        'answer_type': 'text',
-                        'addition_buttons': None,
-                        'unaccounted': unaccounted,
-                        'images': None,
-                        'card_data': None,
-                        'buttons': None
-                        }
+            except BaseException:
+                try:
+                    await batches.aclose()
+                finally:
+                    # the cursor may have been left mid-result
+                    await connectors.release_connection(db_type, conn, discard=True)
+                    conn = None
+                raise
+            finally:
+                await batches.aclose()
         else:
             # Error message
 
@@ -614,16 +706,123 @@ async def parsing_text(channel_id: str, text: str) -> NLSQLAnswer:
                     'card_data': None,
                     'buttons': None
                     }
+    finally:
+        # Hand the connection back even when an answer branch fails or never used it
+        if conn is not None:
+            await connectors.release_connection(db_type, conn)
+
+
+def canonical_message(message: str) -> str:
+    message = message.replace('\u200b', '').strip()
+    if _VERBATIM_TEXT.search(message):
+        return message
+    return ' '.join(message.split()).lower()
+
+
+def invalidate_translation_cache():
+    """Drop every cached translation, e.g. after the data-source schema has changed"""
+    translation_cache.clear()
+    logging.info("NLSQL API translation cache invalidated")
+
+
+def limit_rows(db_type, sql: str, count: int) -> str:
+    # Push an answer's row cap down into its SQL, unchanged when the statement can't be limited
+    if os.getenv('RowLimitPushdown', '1') in ('0', 'false', 'False'):
+        return sql
+    return dialects.page_sql(db_type, sql, count) or sql
+
+
+def last_rows_sql(db_type, sql, count: int) -> Union[str, None]:
+    if not isinstance(sql, str) or os.getenv('RowLimitPushdown', '1') in ('0', 'false', 'False'):
+        return None
+    return dialects.last_rows_sql(db_type, sql, count)
+
+
+async def get_elements_page(db_type, conn, sql: str, graph_range: int, after=None):
+    """Elements graph_range - PAGE_SIZE .. graph_range of a complex chart, read with a query bounded to the page.
+
+    With after set and a keyset element query (see dialects.keyset_column) the page starts after that element instead
+    of skipping rows. Returns (elements, whether more follow, keyset value to continue after) or None when the query
+    can't be bounded.
+    """
+    keyset = dialects.keyset_column(sql, db_type)
+    if keyset is not None and after is not None:
+        count = PAGE_SIZE
+        page_sql = dialects.keyset_page_sql(db_type, sql, count + 1, *keyset)
+        params = [after]
+    else:
+        offset = max(graph_range - PAGE_SIZE, 0)
+        count = graph_range - offset
+        page_sql = dialects.page_sql(db_type, sql, count + 1, offset)
+        params = None
+    if page_sql is None or count < 1:
+        return None
+    rows = await connectors.do_query(db_type, conn, page_sql, params=params)
+    elements = rows[:count]
+    return elements, len(rows) > count, elements[-1][0] if keyset is not None and elements else None
+
+
+async def save_continuation(channel_id, conversation_id, state: Dict, api_response: Dict, next_range: int,
+                            after=None) -> str:
+    """Store the translation of the next page in the conversation's state and return its continuation token"""
+    token = secrets.token_urlsafe(8)
+    next_response = json.loads(json.dumps(api_response))
+    next_response['sql']['range'] = next_range
+    pages = state.setdefault('pages', {})
+    pages[token] = {'api_response': next_response, 'after': after}
+    while len(pages) > MAX_CONTINUATIONS:
+        pages.pop(next(iter(pages)))
+    await session.save(channel_id, conversation_id, state)
+    return token
+
+
+async def do_batched_query(db_type, conn, sql: str, elements: List) -> Union[Dict, None]:
+    # One statement for all elements of a complex chart, None falls back to one query per element and means the
+    # connection has been handed back
+    discard = False
+    if os.getenv('QueryBatching', '1') not in ('0', 'false', 'False'):
+        try:
+            result = await connectors.do_batched_query(db_type, conn, sql, elements)
+        except Exception as e:
+            logging.warning(f"Batched element query failed, running one query per element: {e}")
+            # the failed statement may have left the connection unusable (e.g. an aborted transaction)
+            discard = True
+        else:
+            if result is not None:
+                return result
+    await connectors.release_connection(db_type, conn, discard=discard)
+    return None
+
+
+async def do_queries(db_type, db_param, queries: Dict, map_mode) -> Dict:
+    try:
+        return await connectors.do_queries(db_type, db_param, queries, map_mode=map_mode)
+    except asyncio.TimeoutError:
+        # answered with the 'fail' message, like an empty result
+        logging.warning(f"{len(queries)} chart queries did not finish within the deadline")
+        return {}
 
 
 # NLSQL-API connection
 async def api_post(message):
     url = os.getenv('ApiEndPoint')
+    cache_key = (url, canonical_message(message))
+    if translation_cache.enabled:
+        cached = translation_cache.get(cache_key)
+        if cached is not None:
+            # cached as raw text: callers mutate the parsed response
+            return json.loads(cached)
+
     payload = {"message": message}
     # nlsql api token
     headers = {'Authorization': 'Token ' + os.getenv('ApiToken'),
                "Content-Type": "application/json"}
-    result = requests.post(url, headers=headers, json=payload).json()
+    session = await http_client.get_session()
+    async with session.post(url, headers=headers, json=payload) as response:
+        text = await response.text()
+        result = json.loads(text)
+        if response.status == 200 and isinstance(result, dict):
+            translation_cache.set(cache_key, text)
     return result
 
 
@@ -639,15 +838,8 @@ async def words(word):
         yield word[i]
 
 
-async def write_csv(data, path, mod, indicator=None):
-    if mod == 'add':
-        use_mod = 'a'
-    else:
-        use_mod = 'w'
-
-    with open(path, use_mod, newline='') as f:
-        writer0 = csv.writer(f, delimiter=',')
-        if indicator:
-            writer0.writerow((indicator))
-        async for i in words(data):
-            writer0.writerow((i))
+async def chain_batches(first: List, rest):
+    yield first
+    async for batch in rest:
+        yield batch
+
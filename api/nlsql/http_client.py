@@ -0,0 +1,34 @@
+import asyncio
+from typing import Union
+
+import aiohttp
+
+from .config import get_int_env, get_number_env
+
+# Shared NLSQL API client: one keep-alive connection pool per event loop, reused by every message
+_session: Union[aiohttp.ClientSession, None] = None
+_session_loop: Union[asyncio.AbstractEventLoop, None] = None
+
+
+async def get_session() -> aiohttp.ClientSession:
+    global _session
+    global _session_loop
+
+    loop = asyncio.get_event_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        connector = aiohttp.TCPConnector(limit=get_int_env('ApiPoolSize', 100),
+                                         limit_per_host=get_int_env('ApiPoolSizePerHost', 20),
+                                         keepalive_timeout=get_number_env('ApiKeepAliveTimeout', 60))
+        timeout = aiohttp.ClientTimeout(total=get_number_env('ApiTimeout', 120),
+                                        sock_connect=get_number_env('ApiConnectTimeout', 10))
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        _session_loop = loop
+    return _session
+
+
+async def close_session():
+    global _session
+
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
@@ -0,0 +1,71 @@
+import logging
+import os
+import secrets
+import threading
+from typing import List, Union
+
+import plotly.io as pio
+
+# Static image export through kaleido. plotly keeps one kaleido scope per process whose headless Chromium is started by
+# the first export and reused by the following ones, so the start-up is paid once per process (see warm()) instead of
+# per chart. The scope talks to Chromium over a single pipe, exports are serialised by _lock.
+_lock = threading.Lock()
+
+
+def _alive() -> bool:
+    proc = getattr(pio.kaleido.scope, '_proc', None)
+    return proc is not None and proc.poll() is None
+
+
+def _to_image(fig, fmt: str, **kwargs) -> bytes:
+    try:
+        return pio.to_image(fig, format=fmt, engine='kaleido', **kwargs)
+    except Exception as e:
+        if _alive():
+            raise
+        # Chromium died (or never started): the scope starts a new one on the next export
+        logging.warning(f'Kaleido renderer is not running, restarting it: {e}')
+        return pio.to_image(fig, format=fmt, engine='kaleido', **kwargs)
+
+
+def warm():
+    """Start this process' Chromium ahead of the first chart"""
+    try:
+        to_image({'data': [], 'layout': {}}, 'png', width=10, height=10)
+    except Exception as e:
+        logging.warning(f"Can't start the kaleido renderer: {e}")
+
+
+def to_image(fig, fmt: str = 'png', **kwargs) -> bytes:
+    with _lock:
+        return _to_image(fig, fmt, **kwargs)
+
+
+def to_images(figs: List, fmt: str = 'png', **kwargs) -> List[Union[bytes, None]]:
+    """Export several figures in one go on the same Chromium; a figure that fails is logged and returned as None"""
+    images = []
+    with _lock:
+        for fig in figs:
+            try:
+                images.append(_to_image(fig, fmt, **kwargs))
+            except Exception as e:
+                logging.error(f"Can't export figure: {e}")
+                images.append(None)
+    return images
+
+
+def write_image(fig, path: str, **kwargs):
+    """fig.write_image(path, engine='kaleido') on the shared renderer, the format follows the file extension.
+
+    The image is written under a temporary name and renamed when complete.
+    """
+    fmt = os.path.splitext(path)[1].lstrip('.').lower() or 'png'
+    image = to_image(fig, fmt, **kwargs)
+    part = '{}.{}.part'.format(path, secrets.token_hex(4))
+    try:
+        with open(part, 'wb') as f:
+            f.write(image)
+        os.replace(part, path)
+    finally:
+        if os.path.exists(part):
+            os.remove(part)
@@ -0,0 +1,96 @@
+import contextvars
+import functools
+import time
+from contextlib import contextmanager
+from typing import Dict, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from .cache import TTLCache
+
+STAGE_SECONDS = Histogram('nlsql_stage_duration_seconds', 'Time spent in each stage of answering a message',
+                          ['stage', 'data_type', 'db_type'],
+                          buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+STAGE_ERRORS = Counter('nlsql_stage_errors_total', 'Stages that ended with an exception',
+                       ['stage', 'data_type', 'db_type'])
+REQUESTS = Counter('nlsql_requests_total', 'Messages answered', ['data_type', 'db_type'])
+RENDER_JOBS = Counter('nlsql_render_jobs_total', 'Chart render jobs by outcome: done, rejected (queue full), failed '
+                                                 '(the chart raised), timeout or crashed (worker process died)',
+                      ['outcome'])
+ARTIFACT_FILES = Gauge('nlsql_artifact_files', 'Generated static files in the artifact index at the last sweep')
+ARTIFACT_BYTES = Gauge('nlsql_artifact_bytes', 'Size of the generated static files at the last sweep')
+ARTIFACTS_SWEPT = Counter('nlsql_artifacts_swept_total', 'Generated static files deleted by the sweeper, by reason '
+                                                         '(ttl or quota)', ['reason'])
+ARTIFACT_BYTES_SWEPT = Counter('nlsql_artifacts_swept_bytes_total', 'Bytes of the generated static files deleted by '
+                                                                    'the sweeper, by reason', ['reason'])
+
+# (data_type, db_type) of the message being answered, inherited by the tasks it spawns
+_labels: contextvars.ContextVar = contextvars.ContextVar('nlsql_metric_labels', default=('', ''))
+
+
+def set_labels(data_type: str = '', db_type: str = ''):
+    _labels.set((data_type or '', db_type or ''))
+
+
+def observe(stage: str, seconds: float):
+    STAGE_SECONDS.labels(stage, *_labels.get()).observe(seconds)
+
+
+@contextmanager
+def timer(stage: str):
+    """Record the duration of the block under the current message's labels"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.labels(stage, *_labels.get()).inc()
+        raise
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def timed(stage: str):
+    """timer() for a whole coroutine function"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with timer(stage):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class _CacheCollector:
+    def __init__(self):
+        self.caches: Dict[str, TTLCache] = {}
+
+    def collect(self):
+        size = GaugeMetricFamily('nlsql_cache_entries', 'Entries held by the cache', labels=['cache'])
+        size_bytes = GaugeMetricFamily('nlsql_cache_bytes', 'Estimated size of the cached values', labels=['cache'])
+        events = CounterMetricFamily('nlsql_cache_lookups', 'Cache lookups by outcome; stale lookups found an '
+                                                            'expired entry and are also counted as misses',
+                                     labels=['cache', 'event'])
+        evictions = CounterMetricFamily('nlsql_cache_evictions', 'Entries evicted to stay within the cache bounds',
+                                        labels=['cache'])
+        for name, cache in self.caches.items():
+            stats = cache.stats()
+            size.add_metric([name], stats['size'])
+            size_bytes.add_metric([name], stats['bytes'])
+            for event in ('hits', 'misses', 'stale'):
+                events.add_metric([name, event], stats[event])
+            evictions.add_metric([name], stats['evictions'])
+        return [size, size_bytes, events, evictions]
+
+
+_cache_collector = _CacheCollector()
+REGISTRY.register(_cache_collector)
+
+
+def register_cache(name: str, cache: TTLCache):
+    _cache_collector.caches[name] = cache
+
+
+def render() -> Tuple[bytes, str]:
+    """Metrics of this worker process in the Prometheus text format: (body, content type)"""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
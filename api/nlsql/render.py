@@ -0,0 +1,146 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Union
+
+from . import metrics
+from .config import get_int_env, get_number_env
+
+# Charts are built by the graph.build_html_* functions in a pool of worker processes, so plotly figure construction,
+# write_html and the kaleido export neither hold this worker's GIL nor block its event loop. Workers are spawned (not
+# forked from a process with running threads and open connections) and warmed up before the first chart.
+
+
+class RenderUnavailable(Exception):
+    """The chart could not be rendered: the queue is full, the job failed or timed out, or its worker process
+    crashed"""
+
+
+_pool: Union[ProcessPoolExecutor, None] = None
+_pending = 0
+# Pools restarted because one of their jobs timed out, their other jobs are retried without counting as crashed
+_timed_out = weakref.WeakSet()
+
+
+def _workers() -> int:
+    return get_int_env('RenderWorkers', 2)
+
+
+def _warm():
+    # pay for the plotly imports, validators and the kaleido start-up once per worker instead of in the first chart; a
+    # failure here must not break the pool, the chart itself reports it
+    try:
+        import plotly.graph_objects as go
+        from . import images
+
+        go.Figure(go.Scatter(x=[0], y=[0])).to_html(include_plotlyjs=False)
+        images.warm()
+    except Exception as e:
+        logging.warning(f"Can't warm up the chart renderer: {e}")
+
+
+def _ping():
+    return True
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=_workers(), mp_context=multiprocessing.get_context('spawn'),
+                                    initializer=_warm)
+    return _pool
+
+
+def _restart(pool: ProcessPoolExecutor):
+    """Kill the processes of a broken or hung pool, the next job starts a fresh one"""
+    global _pool
+
+    if _pool is pool:
+        _pool = None
+    processes = list((getattr(pool, '_processes', None) or {}).values())
+    pool.shutdown(wait=False)
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+
+
+def start():
+    """Start and warm up the worker processes (call once the server process has forked)"""
+    if _workers() > 0:
+        pool = _get_pool()
+        for _ in range(_workers()):
+            pool.submit(_ping)
+
+
+def shutdown():
+    global _pool
+
+    if _pool is not None:
+        _pool.shutdown(wait=False)
+        _pool = None
+
+
+async def run(func, *args, **kwargs):
+    """Run the module-level function func(*args, **kwargs) in the render pool and return its result.
+
+    At most RenderWorkers + RenderQueueSize jobs of this process are in flight, further ones are rejected instead of
+    queueing behind them. A job is abandoned after RenderTimeout seconds, which restarts the pool, and a job whose
+    worker process died or whose pool was restarted is retried once on a fresh pool. Any failure raises
+    RenderUnavailable. RenderWorkers=0 renders in the calling thread.
+    """
+    global _pending
+
+    workers = _workers()
+    if workers <= 0:
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            logging.exception('Chart rendering failed')
+            metrics.RENDER_JOBS.labels('failed').inc()
+            raise RenderUnavailable(f'chart rendering failed: {e}') from e
+    if _pending >= workers + get_int_env('RenderQueueSize', 8):
+        metrics.RENDER_JOBS.labels('rejected').inc()
+        raise RenderUnavailable('chart render queue is full')
+    timeout = get_number_env('RenderTimeout', 60)
+    job = functools.partial(func, *args, **kwargs)
+    _pending += 1
+    try:
+        for _ in range(2):
+            pool = _get_pool()
+            try:
+                future = pool.submit(job)
+                result = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+            except BrokenProcessPool:
+                if pool in _timed_out:
+                    logging.info('Render pool was restarted for a job that timed out, retrying the chart')
+                    continue
+                logging.warning('Chart render worker died, restarting the render pool')
+                metrics.RENDER_JOBS.labels('crashed').inc()
+                _restart(pool)
+                continue
+            except asyncio.TimeoutError:
+                metrics.RENDER_JOBS.labels('timeout').inc()
+                if not future.cancelled():
+                    # the job is running and there is no stopping a single job of a process pool: the whole pool is
+                    # restarted and the other charts in flight on it start over on the new one
+                    logging.warning(f'Chart rendering took longer than {timeout}s, restarting the render pool')
+                    _timed_out.add(pool)
+                    _restart(pool)
+                raise RenderUnavailable(f'chart rendering timed out after {timeout}s')
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # raised by the graph function itself
+                logging.warning(f'Chart rendering failed: {e!r}')
+                metrics.RENDER_JOBS.labels('failed').inc()
+                raise RenderUnavailable(f'chart rendering failed: {e}') from e
+            metrics.RENDER_JOBS.labels('done').inc()
+            return result
+        raise RenderUnavailable('chart render worker crashed')
+    finally:
+        _pending -= 1
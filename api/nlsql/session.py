@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import os
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, Tuple, Union
+
+from . import metrics
+from .cache import TTLCache
+from .config import get_int_env, get_number_env
+
+# Per-conversation answer state (e.g. the element list behind "Show next 10 elements"), keyed on
+# (channel id, conversation id). Values are stored as JSON, their encoded size counts against SessionMaxBytes.
+# Values JSON can't represent (e.g. dates and decimals of query results) are stored as their str().
+SessionKey = Tuple[str, str]
+
+
+class MemorySessionStore:
+    """Sessions of this worker process, LRU evicted within the byte budget and expired after ttl seconds"""
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self._cache = TTLCache(maxsize=0, ttl=ttl, max_bytes=max_bytes)
+        metrics.register_cache('session', self._cache)
+
+    def get(self, key: SessionKey) -> Union[bytes, None]:
+        return self._cache.get(key)
+
+    def set(self, key: SessionKey, value: bytes):
+        # a state over the whole budget is not kept, and neither is the one it replaces
+        self._cache.delete(key)
+        self._cache.set(key, value, size=len(value))
+
+    def delete(self, key: SessionKey):
+        self._cache.delete(key)
+
+
+class SqliteSessionStore:
+    """Sessions shared by every worker on the host through a local SQLite file"""
+
+    def __init__(self, path: str, max_bytes: int, ttl: float):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS sessions (channel_id TEXT, conversation_id TEXT, '
+                         'value BLOB, size INTEGER, expires_at REAL, used_at REAL, '
+                         'PRIMARY KEY (channel_id, conversation_id))')
+            conn.execute('CREATE INDEX IF NOT EXISTS sessions_used_at ON sessions (used_at)')
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: SessionKey) -> Union[bytes, None]:
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute('SELECT value FROM sessions WHERE channel_id = ? AND conversation_id = ? '
+                               'AND expires_at > ?', (*key, now)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE sessions SET used_at = ? WHERE channel_id = ? AND conversation_id = ?',
+                         (now, *key))
+        return row[0]
+
+    def set(self, key: SessionKey, value: bytes):
+        if self.max_bytes and len(value) > self.max_bytes:
+            self.delete(key)
+            return
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?)',
+                         (*key, value, len(value), now + self.ttl, now))
+            conn.execute('DELETE FROM sessions WHERE expires_at <= ?', (now,))
+            if self.max_bytes:
+                # drop the least recently used sessions until the rest fits the budget
+                conn.execute('DELETE FROM sessions WHERE rowid IN (SELECT rowid FROM (SELECT rowid, SUM(size) OVER '
+                             '(ORDER BY used_at DESC) AS total FROM sessions) WHERE total > ?)', (self.max_bytes,))
+
+    def delete(self, key: SessionKey):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM sessions WHERE channel_id = ? AND conversation_id = ?', key)
+
+
+_store: Union[MemorySessionStore, SqliteSessionStore, None] = None
+
+
+def get_store() -> Union[MemorySessionStore, SqliteSessionStore]:
+    global _store
+
+    if _store is None:
+        max_bytes = get_int_env('SessionMaxBytes', 64 * 1024 * 1024)
+        ttl = get_number_env('SessionTTL', 3600)
+        if os.getenv('SessionBackend', 'memory').lower() == 'sqlite':
+            _store = SqliteSessionStore(os.getenv('SessionPath', '/tmp/nlsql-sessions.sqlite3'), max_bytes, ttl)
+        else:
+            _store = MemorySessionStore(max_bytes, ttl)
+    return _store
+
+
+async def _call(func, *args):
+    if isinstance(get_store(), SqliteSessionStore):
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+    return func(*args)
+
+
+async def load(channel_id: str, conversation_id: str) -> Dict:
+    """State of the conversation, an empty dict when there is none"""
+    if not conversation_id:
+        return {}
+    try:
+        value = await _call(get_store().get, (channel_id, conversation_id))
+        return json.loads(value) if value else {}
+    except Exception as e:
+        logging.warning(f"Can't load session state: {e}")
+        return {}
+
+
+async def save(channel_id: str, conversation_id: str, state: Dict):
+    """Store the state of the conversation. Without a conversation id nothing is stored: every such request of the
+    channel would share one state"""
+    if not conversation_id:
+        logging.warning(f"Not saving session state of channel {channel_id}: the request has no conversation_id")
+        return
+    try:
+        value = json.dumps(state, default=str, separators=(',', ':')).encode()
+        await _call(get_store().set, (channel_id, conversation_id), value)
+    except Exception as e:
+        logging.warning(f"Can't save session state: {e}")
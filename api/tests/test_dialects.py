@@ -0,0 +1,49 @@
+from api.nlsql.connectors import dialects
+
+
+def test_batch_shifts_positional_group_by_and_order_by():
+    sql = dialects.batch_elements_sql('mysql', "SELECT d, SUM(v) FROM t WHERE n = '{}' GROUP BY 1 ORDER BY 1", 2)
+    assert sql == ("SELECT 0 AS nlsql_batch, d, SUM(v) FROM t WHERE n = %s GROUP BY 2\n"
+                   "UNION ALL\n"
+                   "SELECT 1 AS nlsql_batch, d, SUM(v) FROM t WHERE n = %s GROUP BY 2\n"
+                   "ORDER BY 1, 2")
+
+
+def test_batch_keeps_named_group_by_and_having():
+    sql = dialects.batch_elements_sql('postgresql', "SELECT d, SUM(v) FROM t WHERE n = '{}' "
+                                                    "GROUP BY d, 2 HAVING SUM(v) > 1 ORDER BY t.d DESC, 2", 1)
+    assert sql == ("SELECT 0 AS nlsql_batch, d, SUM(v) FROM t WHERE n = %s GROUP BY d, 3 HAVING SUM(v) > 1\n"
+                   "ORDER BY 1, d DESC, 3")
+
+
+def test_batch_ignores_positions_inside_subqueries():
+    sql = dialects.batch_elements_sql('mssql', "SELECT d, (SELECT MAX(x) FROM u GROUP BY 1) FROM t "
+                                               "WHERE n = '{}' GROUP BY d", 1)
+    assert sql == ("SELECT 0 AS nlsql_batch, d, (SELECT MAX(x) FROM u GROUP BY 1) FROM t WHERE n = ? GROUP BY d\n"
+                   "ORDER BY 1")
+
+
+def test_batch_rollup_is_not_batched():
+    assert dialects.batch_elements_sql('mysql', "SELECT d, SUM(v) FROM t WHERE n = '{}' GROUP BY ROLLUP(1)", 1) \
+        is None
+
+
+def test_batch_keeps_distinct_in_front_of_batch_column():
+    sql = dialects.batch_elements_sql('bigquery', "SELECT DISTINCT d FROM t WHERE n = '{}'", 2)
+    assert sql == ("SELECT DISTINCT 0 AS nlsql_batch, d FROM t WHERE n = @nlsql_el_0\n"
+                   "UNION ALL\n"
+                   "SELECT DISTINCT 1 AS nlsql_batch, d FROM t WHERE n = @nlsql_el_1\n"
+                   "ORDER BY 1")
+
+
+def test_batch_limited_template_is_not_batched():
+    assert dialects.batch_elements_sql('mysql', "SELECT d FROM t WHERE n = '{}' ORDER BY 1 LIMIT 10", 2) is None
+    assert dialects.batch_elements_sql('mssql', "SELECT TOP 10 d FROM t WHERE n = '{}'", 2) is None
+
+
+def test_page_mssql_tops_a_single_select():
+    assert dialects.page_sql('mssql', 'SELECT a FROM t', 20) == 'SELECT TOP 20 a FROM t'
+
+
+def test_page_mssql_compound_without_order_by_is_not_paged():
+    assert dialects.page_sql('mssql', 'SELECT a FROM t UNION ALL SELECT b FROM u', 20) is None
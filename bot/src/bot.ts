@@ -48,7 +48,8 @@ export class Bot extends ActivityHandler {
             await Bot.createActivityTyping(context);
 
             // # nlsql logic and parsing answer
-            const nlsql_answer = await this.apiPost(context.activity.channelId, context.activity.text);
+            const nlsql_answer = await this.apiPost(context.activity.channelId, context.activity.conversation.id,
+                context.activity.text);
 
             if (this.debug) console.log('nlsql_answer: ', nlsql_answer);
 
@@ -169,9 +170,10 @@ export class Bot extends ActivityHandler {
     }
 
     // TODO Pass URL variable in here
-    private async apiPost(channelId: string, text: string) {
+    private async apiPost(channelId: string, conversationId: string, text: string) {
         const body = {
             'channel_id': channelId,
+            'conversation_id': conversationId,
             'text': text
         }
 